@@ -0,0 +1,70 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md_to_docx  # noqa: E402
+
+DEFAULT_SIZES = (1_000, 10_000, 50_000)
+CHAPTER_COUNT = 20
+# Допустимый рост времени на один заголовок между самым малым и большим размером
+MAX_PER_HEADING_GROWTH = 2.0
+
+
+def write_corpus(root_directory: str, headings: int) -> None:
+    for index in range(CHAPTER_COUNT):
+        with open(
+            os.path.join(root_directory, f"chapter_{index}.md"), "w", encoding="utf-8"
+        ) as f:
+            f.write(f"# Chapter {index}\n\nChapter text.\n")
+
+    lines = []
+    for index in range(headings):
+        if index % 2:
+            # Ссылка из заголовка на главу: пустой абзац и вставка главы
+            lines.append(f"## [Chapter](chapter_{index % CHAPTER_COUNT}.md)\n")
+        else:
+            lines.append(f"## Heading {index}\n\nParagraph {index}.\n")
+    with open(
+        os.path.join(root_directory, md_to_docx.README_FILE), "w", encoding="utf-8"
+    ) as f:
+        f.write("\n".join(lines))
+
+
+def bench_size(headings: int, template: bytes) -> float:
+    with tempfile.TemporaryDirectory() as root_directory:
+        write_corpus(root_directory, headings)
+        output = os.path.join(root_directory, "out.docx")
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            md_to_docx.convert_markdown_to_docx(
+                root_directory, output, cache_dir=None, template=template
+            )
+        return time.perf_counter() - started
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Document assembly scaling")
+    parser.add_argument("sizes", nargs="*", type=int, default=DEFAULT_SIZES)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    template = md_to_docx.create_document_template()
+    per_heading = []
+    print(f"{'headings':>10}{'seconds':>12}{'us/heading':>14}")
+    for headings in args.sizes:
+        seconds = bench_size(headings, template)
+        per_heading.append(seconds / headings)
+        print(f"{headings:>10}{seconds:>12.2f}{seconds / headings * 1e6:>14.1f}")
+
+    growth = per_heading[-1] / per_heading[0]
+    print(f"per-heading growth: x{growth:.2f} (limit x{MAX_PER_HEADING_GROWTH})")
+    if growth > MAX_PER_HEADING_GROWTH:
+        sys.exit(1)
@@ -0,0 +1,97 @@
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import md_to_docx  # noqa: E402
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_REPEAT = 5
+
+
+def markdown_files(root_directory: str) -> list[str]:
+    pattern = os.path.join(root_directory, "**", f"*{md_to_docx.MD_EXT}")
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def bench_parse(root_directory: str, backend: str, repeat: int) -> float:
+    files = markdown_files(root_directory)
+    best = float("inf")
+    for _ in range(repeat):
+        context = md_to_docx.ConversionContext(
+            root_directory=root_directory, backend=backend
+        )
+        started = time.perf_counter()
+        for file_path in files:
+            parsed = md_to_docx.parse_markdown(context, file_path)
+            # Обход дерева так же, как при рендеринге
+            parsed.soup.get_text()
+            del context.parsed_markdown[file_path]
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_build(root_directory: str, backend: str, repeat: int, output: str) -> float:
+    template = md_to_docx.create_document_template()
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            md_to_docx.convert_markdown_to_docx(
+                root_directory,
+                output,
+                cache_dir=None,
+                template=template,
+                backend=backend,
+            )
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def document_xml(path: str) -> bytes:
+    with zipfile.ZipFile(path) as archive:
+        return archive.read("word/document.xml")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compare etree and bs4 backends")
+    parser.add_argument("root_directory", nargs="?", default=ROOT_DIRECTORY)
+    parser.add_argument("-n", "--repeat", type=int, default=DEFAULT_REPEAT)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs = {}
+        for backend in md_to_docx.MARKDOWN_BACKENDS:
+            outputs[backend] = os.path.join(tmp, f"{backend}.docx")
+            results[backend] = (
+                bench_parse(args.root_directory, backend, args.repeat),
+                bench_build(
+                    args.root_directory, backend, args.repeat, outputs[backend]
+                ),
+            )
+        same = len({document_xml(path) for path in outputs.values()}) == 1
+
+    print(f"{'backend':<10}{'parse':>12}{'build':>12}")
+    for backend, (parse_seconds, build_seconds) in results.items():
+        print(
+            f"{backend:<10}{parse_seconds * 1000:>10.1f}ms{build_seconds * 1000:>10.1f}ms"
+        )
+    etree_parse, etree_build = results[md_to_docx.BACKEND_ETREE]
+    bs4_parse, bs4_build = results[md_to_docx.BACKEND_BS4]
+    print(
+        f"speedup: parse x{bs4_parse / etree_parse:.2f}, build x{bs4_build / etree_build:.2f}"
+    )
+    print(f"document.xml identical: {same}")
+    if not same:
+        sys.exit(1)
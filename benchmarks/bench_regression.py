@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, replace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import CorpusShape, generate_corpus  # noqa: E402
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+BASE_SHAPE = CorpusShape()
+# Каждое измерение корпуса масштабируется отдельно, остальные остаются базовыми
+SCALED_DIMENSIONS = (
+    "chapters",
+    "depth",
+    "paragraphs",
+    "table_rows",
+    "table_cols",
+    "listings",
+    "images",
+    "links",
+)
+DEFAULT_FACTORS = (4, 16)
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 10.0
+
+
+def scenarios(factors: tuple[int, ...]) -> dict[str, CorpusShape]:
+    shapes = {"base": BASE_SHAPE}
+    for dimension in SCALED_DIMENSIONS:
+        for factor in factors:
+            value = max(getattr(BASE_SHAPE, dimension), 1) * factor
+            shapes[f"{dimension}-x{factor}"] = replace(BASE_SHAPE, **{dimension: value})
+    return shapes
+
+
+def measure_build(root_directory: str, output: str) -> None:
+    # Выполняется в отдельном процессе, чтобы пиковая память не копилась
+    sys.path.insert(0, ROOT_DIRECTORY)
+    import md_to_docx
+
+    started = time.perf_counter()
+    md_to_docx.convert_markdown_to_docx(root_directory, output, cache_dir=None)
+    seconds = time.perf_counter() - started
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps({"seconds": seconds, "max_rss": max_rss}))
+
+
+def run_build(root_directory: str, output: str) -> dict:
+    completed = subprocess.run(
+        [sys.executable, __file__, "--measure", root_directory, output],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    result = json.loads(completed.stdout.splitlines()[-1])
+    result["output_bytes"] = os.path.getsize(output)
+    return result
+
+
+def bench_scenario(shape: CorpusShape, repeat: int) -> dict:
+    with tempfile.TemporaryDirectory() as root_directory:
+        generate_corpus(root_directory, shape)
+        output = os.path.join(root_directory, "out.docx")
+        runs = [run_build(root_directory, output) for _ in range(repeat)]
+    best = min(runs, key=lambda run: run["seconds"])
+    return {
+        "shape": asdict(shape),
+        "seconds": best["seconds"],
+        "max_rss": max(run["max_rss"] for run in runs),
+        "output_bytes": best["output_bytes"],
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        completed = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIRECTORY,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return completed.stdout.strip()
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, result in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+        change = (result["seconds"] / previous["seconds"] - 1) * 100
+        if change > threshold:
+            regressions.append(
+                f"{name}: {previous['seconds']:.3f}s -> {result['seconds']:.3f}s"
+                f" ({change:+.1f}%, limit {threshold:.1f}%)"
+            )
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="md_to_docx regression benchmark")
+    parser.add_argument("--measure", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument("--factors", nargs="*", type=int, default=DEFAULT_FACTORS)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--only", nargs="*", help="run only these scenarios")
+    parser.add_argument("--save", help=f"store results as <name>.json in {RESULTS_DIR}")
+    parser.add_argument("--baseline", help="stored results name to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="fail when a scenario is slower than the baseline by this percent",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.measure:
+        measure_build(*args.measure)
+        sys.exit(0)
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scenarios": {},
+    }
+    print(f"{'scenario':<16}{'seconds':>10}{'peak MB':>10}{'output KB':>12}")
+    for name, shape in scenarios(tuple(args.factors)).items():
+        if args.only and name not in args.only:
+            continue
+        result = bench_scenario(shape, args.repeat)
+        results["scenarios"][name] = result
+        print(
+            f"{name:<16}{result['seconds']:>10.3f}"
+            f"{result['max_rss'] / 2**20:>10.1f}"
+            f"{result['output_bytes'] / 2**10:>12.1f}"
+        )
+
+    if args.save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        with open(
+            os.path.join(RESULTS_DIR, f"{args.save}.json"), "w", encoding="utf-8"
+        ) as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(
+            os.path.join(RESULTS_DIR, f"{args.baseline}.json"), encoding="utf-8"
+        ) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
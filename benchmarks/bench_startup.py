@@ -0,0 +1,98 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import CorpusShape, generate_corpus  # noqa: E402
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONVERTER = os.path.join(ROOT_DIRECTORY, "md_to_docx.py")
+DEFAULT_REPEAT = 7
+# Время сверх запуска пустого интерпретатора для путей без сборки
+DEFAULT_BUDGET = 0.2
+# Эти модули не должны загружаться, пока не нужна настоящая сборка
+DEFERRED_MODULES = ("markdown", "bs4", "docx", "lxml", "PIL")
+
+
+def run(arguments: list[str], cwd: str) -> float:
+    started = time.perf_counter()
+    # Упавший запуск быстрее настоящего и прошёл бы бюджет незаметно
+    subprocess.run(
+        [sys.executable, *arguments], cwd=cwd, check=True, capture_output=True
+    )
+    return time.perf_counter() - started
+
+
+def best_time(arguments: list[str], cwd: str, repeat: int) -> float:
+    return min(run(arguments, cwd) for _ in range(repeat))
+
+
+def loaded_deferred_modules(arguments: list[str], cwd: str) -> list[str]:
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", *arguments],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    names = {
+        line.rsplit("|", 1)[1].strip()
+        for line in completed.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return [name for name in DEFERRED_MODULES if name in names]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="md_to_docx cold start budget")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=DEFAULT_BUDGET,
+        help="allowed seconds over a bare interpreter start",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as work_directory:
+        empty_directory = os.path.join(work_directory, "empty")
+        os.mkdir(empty_directory)
+        source_directory = os.path.join(work_directory, "docs")
+        generate_corpus(source_directory, CorpusShape())
+        output = os.path.join(work_directory, "out.docx")
+        # Первая сборка заполняет кэш, дальше замеряется попадание в него
+        subprocess.run(
+            [sys.executable, CONVERTER, source_directory, "-o", output],
+            check=True,
+            capture_output=True,
+        )
+        scenarios = {
+            "--help": [CONVERTER, "--help"],
+            "README.md missing": [CONVERTER, empty_directory],
+            "--deps": [CONVERTER, source_directory, "--deps"],
+            "cached build": [CONVERTER, source_directory, "-o", output],
+        }
+
+        interpreter = best_time(["-c", "pass"], work_directory, args.repeat)
+        print(f"bare interpreter: {interpreter * 1000:.1f}ms")
+        print(f"{'scenario':<20}{'ms':>10}{'over budget':>14}  deferred modules")
+        failed = False
+        for name, arguments in scenarios.items():
+            seconds = best_time(arguments, work_directory, args.repeat) - interpreter
+            loaded = loaded_deferred_modules(arguments, work_directory)
+            over = seconds > args.budget
+            failed = failed or over or bool(loaded)
+            print(
+                f"{name:<20}{seconds * 1000:>10.1f}{'yes' if over else 'no':>14}"
+                f"  {', '.join(loaded) or 'not loaded'}"
+            )
+    print(f"budget: {args.budget * 1000:.0f}ms over a bare interpreter")
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,148 @@
+import argparse
+import os
+import struct
+import zlib
+from dataclasses import dataclass, fields
+
+CHAPTERS_DIR = "chapters"
+CODE_DIR = "code"
+IMAGES_DIR = "images"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@dataclass(frozen=True)
+class CorpusShape:
+    chapters: int = 10
+    # Глубина цепочки вложенных .md внутри каждой главы
+    depth: int = 1
+    paragraphs: int = 20
+    tables: int = 2
+    table_rows: int = 20
+    table_cols: int = 4
+    listings: int = 2
+    listing_lines: int = 40
+    images: int = 1
+    image_size: int = 256
+    links: int = 5
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(kind + data)
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+
+def png_bytes(size: int, seed: int) -> bytes:
+    # Градиент в оттенках серого, разный для каждой картинки
+    rows = b"".join(
+        b"\x00" + bytes((x * (seed + 1) + y) % 256 for x in range(size))
+        for y in range(size)
+    )
+    header = struct.pack(">IIBBBBB", size, size, 8, 0, 0, 0, 0)
+    return (
+        PNG_SIGNATURE
+        + png_chunk(b"IHDR", header)
+        + png_chunk(b"IDAT", zlib.compress(rows))
+        + png_chunk(b"IEND", b"")
+    )
+
+
+def write_file(path: str, content: str | bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if isinstance(content, bytes):
+        with open(path, "wb") as f:
+            f.write(content)
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+def table_markdown(rows: int, cols: int, seed: int) -> str:
+    lines = [
+        "| " + " | ".join(f"Column {col}" for col in range(cols)) + " |",
+        "|" + "---|" * cols,
+    ]
+    lines.extend(
+        "| " + " | ".join(f"{seed}.{row}.{col}" for col in range(cols)) + " |"
+        for row in range(rows)
+    )
+    return "\n".join(lines)
+
+
+def listing_source(lines: int, seed: int) -> str:
+    return "".join(
+        f"def function_{seed}_{line}(value):\n    return value * {line}\n\n"
+        for line in range(max(lines // 3, 1))
+    )
+
+
+def section_markdown(
+    root_directory: str, shape: CorpusShape, name: str, title: str, level: int
+) -> str:
+    blocks = [f"# {title}"]
+    for index in range(shape.paragraphs):
+        text = f"Paragraph {index} of {title} with **bold** and `code` text."
+        if index < shape.links:
+            text += f" See [source {index}](https://example.com/{name}/{index})."
+        blocks.append(text)
+
+    for index in range(shape.tables):
+        blocks.append(table_markdown(shape.table_rows, shape.table_cols, index))
+
+    for index in range(shape.listings):
+        code_name = f"{name}_{index}.py"
+        write_file(
+            os.path.join(root_directory, CODE_DIR, code_name),
+            listing_source(shape.listing_lines, index),
+        )
+        blocks.append(f"[Listing {index}](../{CODE_DIR}/{code_name})")
+
+    for index in range(shape.images):
+        image_name = f"{name}_{index}.png"
+        write_file(
+            os.path.join(root_directory, IMAGES_DIR, image_name),
+            png_bytes(shape.image_size, zlib.crc32(image_name.encode()) % 251),
+        )
+        blocks.append(f"![Figure {index}](../{IMAGES_DIR}/{image_name})")
+
+    if level < shape.depth:
+        child = f"{name}_{level}"
+        blocks.append(f"## [Nested section {level}]({child}.md)")
+        write_file(
+            os.path.join(root_directory, CHAPTERS_DIR, f"{child}.md"),
+            section_markdown(
+                root_directory, shape, child, f"{title}.{level}", level + 1
+            ),
+        )
+    return "\n\n".join(blocks) + "\n"
+
+
+def generate_corpus(root_directory: str, shape: CorpusShape) -> None:
+    lines = []
+    for index in range(shape.chapters):
+        name = f"chapter_{index}"
+        write_file(
+            os.path.join(root_directory, CHAPTERS_DIR, f"{name}.md"),
+            section_markdown(root_directory, shape, name, f"Chapter {index}", 1),
+        )
+        lines.append(f"# [Chapter {index}](./{CHAPTERS_DIR}/{name}.md)\n")
+    write_file(os.path.join(root_directory, "README.md"), "\n".join(lines))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Generate a synthetic README tree")
+    parser.add_argument("root_directory")
+    for shape_field in fields(CorpusShape):
+        parser.add_argument(
+            f"--{shape_field.name.replace('_', '-')}",
+            type=int,
+            default=shape_field.default,
+        )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate_corpus(
+        args.root_directory,
+        CorpusShape(**{f.name: getattr(args, f.name) for f in fields(CorpusShape)}),
+    )
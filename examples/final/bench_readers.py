@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import csv
+import os
+import time
+from typing import TYPE_CHECKING
+
+from chunked_reader import ChunkReader, MmapReader
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+try:
+    import numpy as np
+except ImportError:
+    HAS_NUMPY = False
+else:
+    HAS_NUMPY = True
+
+try:
+    import pandas as pd
+except ImportError:
+    HAS_PANDAS = False
+else:
+    HAS_PANDAS = True
+
+DEFAULT_REPEAT = 3
+
+
+def read_csv_reader(filename: str) -> int:
+    # Исходный разбор из second_version.py: список объектов float
+    data: list[float] = []
+    with open(filename) as file:
+        for row in csv.reader(file):
+            with contextlib.suppress(ValueError, IndexError):
+                data.append(float(row[0]))
+    return len(data)
+
+
+def read_chunks(filename: str) -> int:
+    return sum(len(chunk) for chunk in ChunkReader(filename))
+
+
+def read_mmap(filename: str) -> int:
+    return sum(len(chunk) for chunk in MmapReader(filename))
+
+
+def read_loadtxt(filename: str) -> int:
+    # Разбор целиком в C средствами NumPy: плохие строки не пропускаются,
+    # весь столбец держится в памяти
+    values = np.loadtxt(
+        filename,
+        dtype=np.float64,
+        delimiter=",",
+        usecols=0,
+        comments=None,
+        ndmin=1,
+    )
+    return len(values)
+
+
+def read_pandas(filename: str) -> int:
+    df = pd.read_csv(filename, header=None, names=["value"], on_bad_lines="skip")
+    return len(df["value"].dropna())
+
+
+def readers() -> dict[str, Callable[[str], int]]:
+    found: dict[str, Callable[[str], int]] = {
+        "csv.reader": read_csv_reader,
+        "ChunkReader": read_chunks,
+        "MmapReader": read_mmap,
+    }
+    if HAS_NUMPY:
+        found["np.loadtxt"] = read_loadtxt
+    if HAS_PANDAS:
+        found["pd.read_csv"] = read_pandas
+    return found
+
+
+def generate(filename: str, rows: int) -> None:
+    # Тот же вид данных, что и в data.csv: числа от 1 до rows по одному в строке
+    with open(filename, "w") as file:
+        for start in range(1, rows + 1, 1 << 20):
+            stop = min(start + (1 << 20), rows + 1)
+            file.write("".join(f"{value}\n" for value in range(start, stop)))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Сравнение читателей CSV")
+    parser.add_argument("filename", nargs="?", default="data.csv")
+    parser.add_argument("--rows", type=int, help="создать файл, если его нет")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.exists(args.filename) and args.rows:
+        generate(args.filename, args.rows)
+    print(f"{'reader':<14}{'values':>14}{'seconds':>10}")  # noqa: T201
+    for name, reader in readers().items():
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            try:
+                count = reader(args.filename)
+            except ValueError:
+                count = -1
+            timings.append(time.perf_counter() - started)
+        values = f"{count:_}" if count >= 0 else "bad lines"
+        print(f"{name:<14}{values:>14}{min(timings):>10.2f}")  # noqa: T201
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import csv
+import mmap
+import os
+from array import array
+from itertools import islice
+from operator import itemgetter
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+# 8 МиБ на буфер: столько значений float64 разбирается до передачи дальше
+CHUNK_VALUES = 1 << 20
+ITEM_SIZE = array("d").itemsize
+# Байты файла разбираются блоками, выровненными по концу строки
+BLOCK_BYTES = 1 << 18
+# Диапазон файла на один процесс при параллельной обработке
+SHARD_BYTES = 1 << 26
+
+
+def chunk_values(memory_limit: int) -> int:
+    return max(1, min(CHUNK_VALUES, memory_limit // ITEM_SIZE))
+
+
+class ChunkReader:
+    def __init__(self, filename: str, chunk_size: int = CHUNK_VALUES) -> None:
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.skipped = 0
+
+    def __iter__(self) -> Iterator[array[float]]:
+        # Каждый буфер отдаётся целиком и не переиспользуется, так что
+        # потребитель вправе хранить буферы
+        with open(self.filename) as file:
+            values = map(float, map(itemgetter(0), csv.reader(file)))
+            chunk = array("d")
+            while True:
+                # extend() заполняет буфер в C; значения до плохой строки
+                # остаются в буфере, плохая строка уже прочитана из итератора
+                try:
+                    chunk.extend(islice(values, self.chunk_size - len(chunk)))
+                except (ValueError, IndexError):
+                    self.skipped += 1
+                    continue
+                if len(chunk) < self.chunk_size:
+                    break
+                yield chunk
+                chunk = array("d")
+        if chunk:
+            yield chunk
+
+
+def parse_field(line: bytes) -> float | None:
+    # Медленный путь по правилам csv.reader: кавычки, несколько столбцов
+    try:
+        row = next(csv.reader([line.decode()]), [])
+        return float(row[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def parse_lines(block: bytes) -> tuple[array[float], int]:
+    # Весь блок делится на строки и переводится в float одним проходом в C;
+    # строку, на которой float() упал, разбирает parse_field
+    lines = block.split(b"\n")
+    if not lines[-1]:
+        lines.pop()
+    chunk = array("d")
+    values = map(float, lines)
+    failed = recovered = skipped = 0
+    while True:
+        try:
+            chunk.extend(values)
+        except ValueError:
+            # Номер строки: прочитанные быстрым путём плюс уже упавшие
+            value = parse_field(lines[len(chunk) - recovered + failed])
+            failed += 1
+            if value is None:
+                skipped += 1
+            else:
+                chunk.append(value)
+                recovered += 1
+            continue
+        return chunk, skipped
+
+
+def shard_ranges(filename: str, shard_size: int = SHARD_BYTES) -> list[tuple[int, int]]:
+    # Граница сдвигается на начало следующей строки, так что каждая строка
+    # целиком попадает ровно в один диапазон
+    with open(filename, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if not size:
+            return []
+        bounds = [0]
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            while bounds[-1] + shard_size < size:
+                newline = mapped.find(b"\n", bounds[-1] + shard_size - 1)
+                if newline == -1 or newline + 1 == size:
+                    break
+                bounds.append(newline + 1)
+    return list(zip(bounds, [*bounds[1:], size], strict=True))
+
+
+class MmapReader:
+    def __init__(
+        self,
+        filename: str,
+        chunk_size: int = CHUNK_VALUES,
+        start: int = 0,
+        stop: int | None = None,
+    ) -> None:
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.start = start
+        self.stop = stop
+        self.skipped = 0
+
+    def blocks(self, mapped: mmap.mmap) -> Iterator[bytes]:
+        start = self.start
+        size = len(mapped) if self.stop is None else min(self.stop, len(mapped))
+        while start < size:
+            end = min(start + BLOCK_BYTES, size)
+            if end < size:
+                newline = mapped.rfind(b"\n", start, end)
+                if newline == -1:
+                    newline = mapped.find(b"\n", end)
+                end = size if newline == -1 else newline + 1
+            yield mapped[start:end]
+            start = end
+
+    def __iter__(self) -> Iterator[array[float]]:
+        with open(self.filename, "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                for block in self.blocks(mapped):
+                    values, skipped = parse_lines(block)
+                    self.skipped += skipped
+                    for start in range(0, len(values), self.chunk_size):
+                        yield values[start : start + self.chunk_size]
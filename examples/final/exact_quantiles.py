@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import math
+import struct
+from array import array
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, NamedTuple
+
+try:
+    import numpy as np
+except ImportError:
+    HAS_NUMPY = False
+else:
+    HAS_NUMPY = True
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Sequence
+
+# Ключ float64 сравнивается как целое без знака в том же порядке, что и числа;
+# каждый проход гистограммы уточняет следующие 16 бит ключа
+HISTOGRAM_BITS = 16
+BUCKETS = 1 << HISTOGRAM_BITS
+KEY_BITS = 64
+SIGN_BIT = 1 << (KEY_BITS - 1)
+KEY_MASK = (1 << KEY_BITS) - 1
+# Короче этого отрезок при выборе без NumPy просто сортируется
+SORTED_RUN = 16
+DOUBLE = struct.Struct("<d")
+UINT64 = struct.Struct("<Q")
+
+
+class KeyRange(NamedTuple):
+    # Диапазон ключей: старшие биты (key >> shift) равны prefix
+    prefix: int
+    shift: int
+
+
+ALL_KEYS = KeyRange(0, KEY_BITS)
+
+
+def float_key(value: float) -> int:
+    bits: int = UINT64.unpack(DOUBLE.pack(value))[0]
+    return bits ^ KEY_MASK if bits & SIGN_BIT else bits | SIGN_BIT
+
+
+def key_float(key: int) -> float:
+    bits = key ^ SIGN_BIT if key & SIGN_BIT else key ^ KEY_MASK
+    value: float = DOUBLE.unpack(UINT64.pack(bits))[0]
+    return value
+
+
+class KeyHistogram:
+    def __init__(self, key_range: KeyRange = ALL_KEYS) -> None:
+        self.key_range = key_range
+        self.shift = key_range.shift - HISTOGRAM_BITS
+        self.counts = [0] * BUCKETS
+        if HAS_NUMPY:
+            self.buffer = np.zeros(BUCKETS, dtype=np.int64)
+
+    def add(self, chunk: array[float]) -> None:
+        prefix, range_shift = self.key_range
+        if not HAS_NUMPY:
+            for value in chunk:
+                key = float_key(value)
+                if key >> range_shift == prefix:
+                    self.counts[(key >> self.shift) & (BUCKETS - 1)] += 1
+            return
+        keys = numpy_keys(chunk)
+        if range_shift < KEY_BITS:
+            keys = keys[keys >> np.uint64(range_shift) == prefix]
+        buckets = (keys >> np.uint64(self.shift)) & np.uint64(BUCKETS - 1)
+        self.buffer += np.bincount(buckets.astype(np.intp), minlength=BUCKETS)
+
+    def result(self) -> list[int]:
+        if HAS_NUMPY:
+            counts: list[int] = self.buffer.tolist()
+            return counts
+        return self.counts
+
+
+def merge_counts(total: list[int], counts: list[int]) -> list[int]:
+    return [a + b for a, b in zip(total, counts, strict=True)]
+
+
+def chunk_candidates(chunk: array[float], key_range: KeyRange) -> array[float]:
+    if not HAS_NUMPY:
+        return array(
+            "d",
+            (
+                value
+                for value in chunk
+                if float_key(value) >> key_range.shift == key_range.prefix
+            ),
+        )
+    mask = numpy_keys(chunk) >> np.uint64(key_range.shift) == key_range.prefix
+    return array("d", np.frombuffer(chunk, dtype=np.float64)[mask].tobytes())
+
+
+def numpy_keys(chunk: array[float]) -> np.ndarray[tuple[int], np.dtype[np.uint64]]:
+    bits = np.frombuffer(chunk, dtype=np.uint64)
+    negative = (bits >> np.uint64(KEY_BITS - 1)).astype(np.bool_)
+    return np.where(negative, ~bits, bits | np.uint64(SIGN_BIT))
+
+
+def histograms(
+    chunks: Iterable[array[float]],
+    ranges: Sequence[KeyRange],
+) -> list[list[int]]:
+    found = [KeyHistogram(key_range) for key_range in ranges]
+    for chunk in chunks:
+        for histogram in found:
+            histogram.add(chunk)
+    return [histogram.result() for histogram in found]
+
+
+def candidates(
+    chunks: Iterable[array[float]],
+    ranges: Sequence[KeyRange],
+) -> list[array[float]]:
+    found = [array("d") for _ in ranges]
+    for chunk in chunks:
+        for values, key_range in zip(found, ranges, strict=True):
+            values.extend(chunk_candidates(chunk, key_range))
+    return found
+
+
+def partition_ranks(values: array[float], ranks: Sequence[int]) -> None:
+    # Трёхпутевое разбиение прямо в массиве, как ndarray.partition: списки
+    # float заняли бы вчетверо больше памяти, чем сам массив
+    pending = [(0, len(values), ranks)]
+    while pending:
+        low, high, wanted = pending.pop()
+        if high - low <= SORTED_RUN:
+            values[low:high] = array("d", sorted(values[low:high]))
+            continue
+        pivot = sorted((values[low], values[(low + high) // 2], values[high - 1]))[1]
+        less, index, greater = low, low, high
+        while index < greater:
+            value = values[index]
+            if value < pivot:
+                values[index], values[less] = values[less], value
+                less += 1
+                index += 1
+            elif value > pivot:
+                greater -= 1
+                values[index], values[greater] = values[greater], value
+            else:
+                index += 1
+        below = [rank for rank in wanted if rank < less]
+        above = [rank for rank in wanted if rank >= greater]
+        if below:
+            pending.append((low, less, below))
+        if above:
+            pending.append((greater, high, above))
+
+
+def select_ranks(values: array[float], ranks: Iterable[int]) -> dict[int, float]:
+    # Частичное упорядочивание на месте сразу по всем рангам
+    ranks = sorted(set(ranks))
+    if not HAS_NUMPY:
+        partition_ranks(values, ranks)
+        return {rank: values[rank] for rank in ranks}
+    view = np.frombuffer(values, dtype=np.float64)
+    view.partition(ranks)
+    return {rank: float(view[rank]) for rank in ranks}
+
+
+@dataclass
+class RankSearch:
+    rank: int
+    # Сколько значений ниже диапазона ключей и сколько внутри него
+    below: int
+    size: int
+    key_range: KeyRange = ALL_KEYS
+
+    def narrow(self, counts: list[int]) -> None:
+        position = self.rank - self.below
+        bucket = 0
+        while position >= counts[bucket]:
+            position -= counts[bucket]
+            self.below += counts[bucket]
+            bucket += 1
+        prefix = self.key_range.prefix << HISTOGRAM_BITS | bucket
+        self.key_range = KeyRange(prefix, self.key_range.shift - HISTOGRAM_BITS)
+        self.size = counts[bucket]
+
+
+class QuantileSearch:
+    # Точный поиск значений по рангам без хранения всех чисел: гистограммы
+    # сужают диапазон ключей, пока кандидаты не поместятся в max_candidates
+    def __init__(self, count: int, ranks: Iterable[int], max_candidates: int) -> None:
+        self.searches = {rank: RankSearch(rank, 0, count) for rank in ranks}
+        self.budget = max(1, max_candidates // max(1, len(self.searches)))
+
+    def pending(self) -> list[KeyRange]:
+        return sorted(
+            {
+                search.key_range
+                for search in self.searches.values()
+                if search.size > self.budget and search.key_range.shift
+            },
+        )
+
+    def collecting(self) -> list[KeyRange]:
+        return sorted(
+            {
+                search.key_range
+                for search in self.searches.values()
+                if search.key_range.shift
+            },
+        )
+
+    def narrow(self, ranges: Sequence[KeyRange], counts: Sequence[list[int]]) -> None:
+        by_range = dict(zip(ranges, counts, strict=True))
+        for search in self.searches.values():
+            if search.key_range in by_range:
+                search.narrow(by_range[search.key_range])
+
+    def finish(
+        self,
+        ranges: Sequence[KeyRange],
+        values: Sequence[array[float]],
+    ) -> dict[int, float]:
+        by_range = dict(zip(ranges, values, strict=True))
+        found: dict[int, float] = {}
+        wanted: dict[KeyRange, dict[int, int]] = {}
+        for rank, search in self.searches.items():
+            if search.key_range.shift:
+                wanted.setdefault(search.key_range, {})[rank - search.below] = rank
+            else:
+                # Ключи диапазона одинаковы, значение восстанавливается из ключа
+                found[rank] = key_float(search.key_range.prefix)
+        for key_range, positions in wanted.items():
+            selected = select_ranks(by_range[key_range], positions)
+            for position, rank in positions.items():
+                found[rank] = selected[position]
+        return found
+
+
+def median_ranks(count: int) -> tuple[int, int]:
+    return (count - 1) // 2, count // 2
+
+
+def quantile_ranks(count: int, quantile: float) -> tuple[int, int, float]:
+    # Линейная интерполяция между соседними рангами, по умолчанию в numpy и pandas
+    position = (count - 1) * quantile
+    lower = math.floor(position)
+    return lower, min(lower + 1, count - 1), position - lower
+
+
+def median_from(found: dict[int, float], count: int) -> float:
+    lower, upper = median_ranks(count)
+    if lower == upper:
+        return found[lower]
+    # Формула повторяет calculate_median
+    return (found[lower] + found[upper]) / 2
+
+
+def quantile_from(found: dict[int, float], count: int, quantile: float) -> float:
+    lower, upper, fraction = quantile_ranks(count, quantile)
+    return found[lower] + (found[upper] - found[lower]) * fraction
+
+
+def search_ranks(
+    source: Callable[[], Iterable[array[float]]],
+    count: int,
+    ranks: Iterable[int],
+    max_candidates: int,
+) -> dict[int, float]:
+    search = QuantileSearch(count, ranks, max_candidates)
+    while ranges := search.pending():
+        search.narrow(ranges, histograms(source(), ranges))
+    ranges = search.collecting()
+    return search.finish(ranges, candidates(source(), ranges) if ranges else [])
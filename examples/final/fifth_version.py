@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import logging
+import os
+import timeit
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import islice, repeat
+from typing import TYPE_CHECKING, TypeVar
+
+from chunked_reader import ITEM_SIZE, MmapReader, chunk_values, shard_ranges
+from exact_quantiles import (
+    ALL_KEYS,
+    BUCKETS,
+    KeyHistogram,
+    KeyRange,
+    QuantileSearch,
+    candidates,
+    histograms,
+    median_from,
+    median_ranks,
+    merge_counts,
+    quantile_from,
+    quantile_ranks,
+    select_ranks,
+)
+from streaming_stats import RunningStats, write_results
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator, Sequence
+
+T = TypeVar("T")
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+# Потолок памяти под значения, общий для родителя и всех процессов: если все
+# числа в него не помещаются, медиана ищется за дополнительные проходы по файлу
+# без хранения всех чисел
+MEMORY_LIMIT = 2 * 2**30
+
+class ShardedFile:
+    # Диапазоны файла и пул процессов, общие для всех проходов по данным
+    def __init__(
+        self,
+        filename: str,
+        chunk_size: int,
+        pool: ProcessPoolExecutor | None,
+    ) -> None:
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.shards = shard_ranges(filename)
+        self.pool = pool
+        self.workers = 1
+
+    def map(self, function: Callable[..., T], *arguments: object) -> Iterator[T]:
+        return self.starmap(function, repeat(arguments))
+
+    def starmap(
+        self,
+        function: Callable[..., T],
+        arguments: Iterable[Sequence[object]],
+    ) -> Iterator[T]:
+        # Одновременно обрабатывается не больше диапазонов, чем процессов: готовые
+        # результаты не копятся в памяти родителя, и аргументы следующего
+        # диапазона берутся только после обработки предыдущего результата
+        rows = (
+            (self.filename, self.chunk_size, start, stop, *extra)
+            for (start, stop), extra in zip(self.shards, arguments, strict=False)
+        )
+        if self.pool is None:
+            for row in rows:
+                yield function(*row)
+            return
+        pending = deque(
+            self.pool.submit(function, *row) for row in islice(rows, self.workers)
+        )
+        while pending:
+            yield pending.popleft().result()
+            pending.extend(self.pool.submit(function, *row) for row in islice(rows, 1))
+
+def scan_shard(
+    filename: str,
+    chunk_size: int,
+    start: int,
+    stop: int,
+    budget: int,
+) -> tuple[RunningStats, list[int], array[float] | None, int]:
+    reader = MmapReader(filename, chunk_size, start, stop)
+    stats = RunningStats()
+    histogram = KeyHistogram()
+    values: array[float] | None = array("d")
+    for chunk in reader:
+        stats.merge(RunningStats.from_array(chunk))
+        histogram.add(chunk)
+        if values is not None and (len(values) + len(chunk)) * ITEM_SIZE > budget:
+            values = None
+        if values is not None:
+            values.extend(chunk)
+    return stats, histogram.result(), values, reader.skipped
+
+def histogram_shard(
+    filename: str,
+    chunk_size: int,
+    start: int,
+    stop: int,
+    ranges: list[KeyRange],
+) -> list[list[int]]:
+    return histograms(MmapReader(filename, chunk_size, start, stop), ranges)
+
+def candidate_shard(
+    filename: str,
+    chunk_size: int,
+    start: int,
+    stop: int,
+    ranges: list[KeyRange],
+) -> list[array[float]]:
+    return candidates(MmapReader(filename, chunk_size, start, stop), ranges)
+
+def read_data(
+    sharded: ShardedFile,
+    memory_limit: int = MEMORY_LIMIT,
+) -> tuple[RunningStats, list[int], array[float] | None]:
+    # Сводки диапазонов сливаются в порядке файла, так что среднее и отклонение
+    # до бита не зависят от числа процессов
+    stats = RunningStats()
+    histogram = [0] * BUCKETS
+    values: array[float] | None = array("d")
+    skipped = 0
+    # Доли потолка и размеры диапазонов в работе в порядке их результатов
+    reserved: deque[tuple[int, int]] = deque()
+    unread = sum(stop - start for start, stop in sharded.shards)
+
+    def budgets() -> Iterator[tuple[int]]:
+        # Диапазон получает не больше ещё не занятой памяти, поэтому числа
+        # родителя и значения в работе вместе не превышают memory_limit. При
+        # нескольких процессах память делится пропорционально байтам ещё не
+        # прочитанной части файла: равномерному файлу, который помещается
+        # целиком, каждой доли хватает, и неиспользованный остаток доли
+        # возвращается следующим диапазонам
+        for start, stop in sharded.shards:
+            held = 0 if values is None else len(values) * ITEM_SIZE
+            budget = memory_limit - held - sum(share for share, _ in reserved)
+            if sharded.workers > 1:
+                budget = min(budget, (memory_limit - held) * (stop - start) // unread)
+            reserved.append((budget, stop - start))
+            yield (budget,)
+
+    for shard_stats, shard_histogram, shard_values, shard_skipped in sharded.starmap(
+        scan_shard,
+        budgets(),
+    ):
+        unread -= reserved.popleft()[1]
+        stats.merge(shard_stats)
+        histogram = merge_counts(histogram, shard_histogram)
+        skipped += shard_skipped
+        if values is None:
+            continue
+        if shard_values is None:
+            logging.info("Значения не помещаются в %d байт", memory_limit)
+            values = None
+        else:
+            values.extend(shard_values)
+    logging.info("Пропущено %d строк", skipped)
+    return stats, histogram, values
+
+def search_ranks(
+    sharded: ShardedFile,
+    search: QuantileSearch,
+    histogram: list[int],
+) -> dict[int, float]:
+    # Гистограмма первого прохода уже собрана при чтении сводки; каждый
+    # следующий проход уточняет диапазон, последний собирает кандидатов
+    search.narrow([ALL_KEYS], [histogram])
+    while ranges := search.pending():
+        totals = [[0] * BUCKETS for _ in ranges]
+        for counts in sharded.map(histogram_shard, ranges):
+            totals = list(map(merge_counts, totals, counts))
+        search.narrow(ranges, totals)
+    ranges = search.collecting()
+    found = [array("d") for _ in ranges]
+    if ranges:
+        for shard_candidates in sharded.map(candidate_shard, ranges):
+            for values, shard_values in zip(found, shard_candidates, strict=True):
+                values.extend(shard_values)
+    return search.finish(ranges, found)
+
+def process_csv(
+    input_file: str,
+    output_file: str,
+    memory_limit: int = MEMORY_LIMIT,
+    workers: int = 1,
+    quantiles: Sequence[float] = (),
+) -> None:
+    logging.info("Чтение файла %s", input_file)
+    with ExitStack() as stack:
+        sharded = ShardedFile(input_file, chunk_values(memory_limit), None)
+        if workers > 1 and len(sharded.shards) > 1:
+            sharded.workers = min(workers, len(sharded.shards))
+            sharded.pool = stack.enter_context(ProcessPoolExecutor(sharded.workers))
+        stats, histogram, values = read_data(sharded, memory_limit)
+
+        if not stats.count:
+            logging.warning("Файл пуст или не содержит числовых данных")
+            write_results(output_file, 0, 0, 0)
+            return
+
+        logging.info("Обработано %d чисел", stats.count)
+        ranks = set(median_ranks(stats.count))
+        for quantile in quantiles:
+            lower, upper, _ = quantile_ranks(stats.count, quantile)
+            ranks.update((lower, upper))
+        if values is not None:
+            found = select_ranks(values, ranks)
+        else:
+            logging.info("Поиск медианы по гистограмме ключей")
+            search = QuantileSearch(stats.count, ranks, memory_limit // ITEM_SIZE)
+            found = search_ranks(sharded, search, histogram)
+
+    logging.info("Вычисление завершено, запись результатов")
+    stats.write_results(
+        output_file,
+        median_from(found, stats.count),
+        {
+            quantile: quantile_from(found, stats.count, quantile)
+            for quantile in quantiles
+        },
+    )
+    logging.info("Результаты записаны в %s", output_file)
+
+if __name__ == "__main__":
+    logging.info(
+        timeit.timeit(
+            partial(
+                process_csv,
+                "data.csv",
+                "results.txt",
+                workers=os.cpu_count() or 1,
+            ),
+            number=1,
+        ),
+    )
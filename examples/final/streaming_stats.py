@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import math
+import operator
+from dataclasses import dataclass
+from itertools import islice
+from typing import TYPE_CHECKING, Self
+
+if TYPE_CHECKING:
+    from array import array
+    from collections.abc import Iterable, Mapping, Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    HAS_NUMPY = False
+else:
+    HAS_NUMPY = True
+
+# Значения читаются из итератора блоками, каждый блок добавляется к итогу
+BLOCK_SIZE = 65536
+
+
+@dataclass
+class RunningStats:
+    count: int = 0
+    mean: float = 0.0
+    # Сумма квадратов отклонений от текущего среднего (алгоритм Уэлфорда)
+    m2: float = 0.0
+    minimum: float = math.inf
+    maximum: float = -math.inf
+
+    @classmethod
+    def from_block(cls, block: Sequence[float]) -> Self:
+        if not block:
+            return cls()
+        mean = math.fsum(block) / len(block)
+        deviations = [value - mean for value in block]
+        m2 = math.fsum(map(operator.mul, deviations, deviations))
+        return cls(len(block), mean, m2, min(block), max(block))
+
+    @classmethod
+    def from_array(cls, chunk: array[float]) -> Self:
+        # Буфер читателя сводится в C через представление NumPy без копии
+        if not HAS_NUMPY or not chunk:
+            return cls.from_block(chunk)
+        values = np.frombuffer(chunk, dtype=np.float64)
+        mean = float(values.mean())
+        m2 = float(np.square(values - mean).sum())
+        return cls(len(values), mean, m2, float(values.min()), float(values.max()))
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+    def extend(self, values: Iterable[float]) -> None:
+        # Один проход по итератору: поэлементный цикл Уэлфорда в CPython
+        # медленнее, чем сводка блока встроенными функциями и слияние
+        iterator = iter(values)
+        while block := list(islice(iterator, BLOCK_SIZE)):
+            self.merge(self.from_block(block))
+
+    def merge(self, other: RunningStats) -> None:
+        # Формула Чана: обобщение Уэлфорда на слияние двух частичных сводок
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+
+    @property
+    def variance(self) -> float:
+        # Дисперсия генеральной совокупности, как в calculate_std_dev
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std_dev(self) -> float:
+        return math.sqrt(self.variance)
+
+    def write_results(
+        self,
+        filename: str,
+        median: float,
+        quantiles: Mapping[float, float] | None = None,
+    ) -> None:
+        write_results(filename, self.mean, median, self.std_dev, quantiles)
+
+
+def select(data: Sequence[float], k: int) -> tuple[float, float]:
+    # Quickselect, трёхпутевое разбиение: k-й и (k + 1)-й по порядку элементы
+    # за линейное в среднем время без сортировки всего списка
+    while True:
+        pivot = sorted((data[0], data[len(data) // 2], data[-1]))[1]
+        lows = [value for value in data if value < pivot]
+        if k < len(lows):
+            if k + 1 < len(lows):
+                data = lows
+                continue
+            return max(lows), pivot
+        highs = [value for value in data if value > pivot]
+        equal = len(data) - len(lows) - len(highs)
+        k -= len(lows)
+        if k + 1 < equal:
+            return pivot, pivot
+        if k < equal:
+            return pivot, min(highs) if highs else pivot
+        k -= equal
+        data = highs
+
+
+def calculate_median(data: Sequence[float]) -> float:
+    middle = len(data) // 2
+    if len(data) % 2 == 0:
+        lower, upper = select(data, middle - 1)
+        return (lower + upper) / 2
+    return select(data, middle)[0]
+
+
+def write_results(
+    filename: str,
+    mean: float,
+    median: float,
+    std_dev: float,
+    quantiles: Mapping[float, float] | None = None,
+) -> None:
+    with open(filename, "w") as file:
+        file.write(f"Среднее: {mean}\n")
+        file.write(f"Медиана: {median}\n")
+        file.write(f"Стандартное отклонение: {std_dev}\n")
+        file.writelines(
+            f"Квантиль {quantile}: {value}\n"
+            for quantile, value in (quantiles or {}).items()
+        )
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import math
+import random
+import statistics
+from array import array
+from typing import TYPE_CHECKING
+
+import pytest
+
+import exact_quantiles
+from exact_quantiles import (
+    median_from,
+    median_ranks,
+    quantile_from,
+    quantile_ranks,
+    search_ranks,
+    select_ranks,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+# Маленькие куски, чтобы гистограммы и кандидаты сливались из многих частей
+CHUNK = 7
+QUANTILES = (0.0, 0.1, 0.25, 0.5, 0.9, 1.0)
+# None - бюджет кандидатов без ограничения
+BUDGETS = (1, 2, 3, 16, 100, None)
+
+generator = random.Random(25)
+DATASETS = {
+    "random": [generator.uniform(-1e6, 1e6) for _ in range(500)],
+    "duplicates": [float(generator.randint(-3, 3)) for _ in range(301)],
+    "constant": [2.5] * 40,
+    "signed_zero": [-0.0, 0.0] * 25 + [-1.0, 1.0, -0.0],
+    "tiny": [1e-300, -1e-300, 5e-324, -5e-324, 0.0],
+    "single": [42.0],
+    "pair": [1.0, 2.0],
+}
+
+
+@pytest.fixture(params=[True, False], ids=["numpy", "python"])
+def numpy_mode(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> None:
+    if request.param and not exact_quantiles.HAS_NUMPY:
+        pytest.skip("NumPy is not installed")
+    monkeypatch.setattr(exact_quantiles, "HAS_NUMPY", request.param)
+
+
+def wanted_ranks(count: int) -> set[int]:
+    ranks = set(median_ranks(count))
+    for quantile in QUANTILES:
+        lower, upper, _ = quantile_ranks(count, quantile)
+        ranks.update((lower, upper))
+    return ranks
+
+
+def chunks(data: list[float]) -> Iterator[array[float]]:
+    for start in range(0, len(data), CHUNK):
+        yield array("d", data[start : start + CHUNK])
+
+
+@pytest.mark.usefixtures("numpy_mode")
+@pytest.mark.parametrize("name", DATASETS)
+def test_select_ranks(name: str) -> None:
+    data = DATASETS[name]
+    ordered = sorted(data)
+    ranks = range(len(data))
+    found = select_ranks(array("d", data), ranks)
+    assert [found[rank] for rank in ranks] == ordered
+    assert median_from(found, len(data)) == statistics.median(data)
+
+
+@pytest.mark.usefixtures("numpy_mode")
+@pytest.mark.parametrize("budget", BUDGETS)
+@pytest.mark.parametrize("name", DATASETS)
+def test_search_ranks(name: str, budget: int | None) -> None:
+    np = pytest.importorskip("numpy")
+    data = DATASETS[name]
+    count = len(data)
+    found = search_ranks(
+        lambda: chunks(data),
+        count,
+        wanted_ranks(count),
+        count if budget is None else budget,
+    )
+    assert median_from(found, count) == statistics.median(data)
+    for quantile in QUANTILES:
+        expected = float(np.quantile(data, quantile))
+        assert math.isclose(
+            quantile_from(found, count, quantile),
+            expected,
+            rel_tol=1e-12,
+            abs_tol=1e-300,
+        )
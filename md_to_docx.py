@@ -1,39 +1,123 @@
+from __future__ import annotations
+
+import argparse
+import cProfile
+import hashlib
+import html
+import importlib.util
+import io
+import json
+import mmap
 import os
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import time
-from datetime import datetime
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+import zipfile
+from array import array
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext, suppress
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timezone
+from functools import cache
+from itertools import chain, groupby, islice
+from typing import TYPE_CHECKING, Self
 from urllib.parse import urlparse
 
-import markdown
-from bs4 import BeautifulSoup
-from docx import Document
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.style import WD_STYLE_TYPE
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
-from docx.shared import Cm, Inches, Pt, RGBColor
-
+if TYPE_CHECKING:
+    import markdown
+    from bs4 import BeautifulSoup
+    from docx.document import Document
+    from docx.image.image import Image
+    from docx.opc.part import Part
+    from docx.oxml import CT_Inline
+    from docx.text.paragraph import Paragraph
+
+# Размеры в EMU: python-docx принимает их как обычные целые числа,
+# а сам модуль docx при запуске не загружается
+EMUS_PER_INCH = 914400
+EMUS_PER_CM = 360000
+EMUS_PER_PT = 12700
 FONT_NAME = "Times New Roman"
-FONT_SIZE = Pt(14)
-FIGURE_FONT_SIZE = Pt(14)
+FONT_SIZE = 14 * EMUS_PER_PT
+FIGURE_FONT_SIZE = 14 * EMUS_PER_PT
 CODE_FONT_NAME = "Courier New"
-CODE_FONT_SIZE = Pt(12)
+CODE_FONT_SIZE = 12 * EMUS_PER_PT
 CODE_LINE_SPACING = 1.0
 CODE_FIRST_LINE_INDENT = 0
-PARAGRAPH_SPACE_BEFORE = Pt(0)
+PARAGRAPH_SPACE_BEFORE = 0
 LINE_SPACING = 1.5
-FIRST_LINE_INDENT = Cm(1.25)
-TOP_MARGIN = Cm(2.0)
-BOTTOM_MARGIN = Cm(2.0)
-LEFT_MARGIN = Cm(3.0)
-RIGHT_MARGIN = Cm(1.5)
-IMAGE_WIDTH = Cm(16.5)
-HYPERLINK_COLOR = RGBColor(0, 0, 255)
-HEADING_COLOR = RGBColor(0, 0, 0)
+FIRST_LINE_INDENT = int(1.25 * EMUS_PER_CM)
+TOP_MARGIN = int(2.0 * EMUS_PER_CM)
+BOTTOM_MARGIN = int(2.0 * EMUS_PER_CM)
+LEFT_MARGIN = int(3.0 * EMUS_PER_CM)
+RIGHT_MARGIN = int(1.5 * EMUS_PER_CM)
+IMAGE_WIDTH = int(16.5 * EMUS_PER_CM)
+HYPERLINK_COLOR = (0, 0, 255)
+HEADING_COLOR = (0, 0, 0)
 TABLE_STYLE = "Table Grid"
+TABLE_CHUNK_ROWS = 1000
+LISTING_RUN_LINES = 1000
+LINE_RANGE_PATTERN = re.compile(r"L(\d+)(?:-L?(\d+))?|(head|tail)=(\d+)")
 MARKDOWN_EXTENSIONS = ["extra", "fenced_code", "tables"]
 README_FILE = "README.md"
-OUTPUT_FILE = f"Lesovoy_{int(time.time())}.docx"
+LISTING_CAPTION = "Листинг"
+FIGURE_CAPTION = "Рисунок"
+REFERENCES_HEADING = "Источники"
+BLOCK_HEADING = "heading"
+BLOCK_PARAGRAPH = "paragraph"
+BLOCK_BULLET = "bullet"
+BLOCK_NUMBER = "number"
+BLOCK_LISTING = "listing"
+BLOCK_FIGURE = "figure"
+BLOCK_TABLE = "table"
+BLOCK_REFERENCE = "reference"
+HEADING_STYLE_PREFIX = "Heading"
+BULLET_STYLE_PREFIX = "ListBullet"
+NUMBER_STYLE_PREFIX = "ListNumber"
+CODE_STYLE = "Code"
+HTML_DOCUMENT = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>{style}</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+HTML_STYLE = (
+    "body{font-family:'Times New Roman',serif;max-width:50em;margin:auto}"
+    "pre{border:1px solid #000;padding:.5em;overflow-x:auto}"
+    "figure{text-align:center}figcaption{font-style:italic}"
+    "figure img{max-width:100%}table{border-collapse:collapse}"
+    "td,th{border:1px solid #000;padding:.2em .5em}"
+)
+OUTPUT_FILE = "Lesovoy_{}.docx"
+BUILD_KEY_LENGTH = 12
+WATCH_OUTPUT_FILE = OUTPUT_FILE.format("preview")
+WATCH_INTERVAL = 0.2
+WATCH_DEBOUNCE = 0.3
+STARTUP_REPORT_LIMIT = 12
+STARTUP_REPORT_MARKER = "--- import_dependencies ---"
+DEPENDENCY_MODULES = (
+    "markdown",
+    "markdown.serializers",
+    "bs4",
+    "docx",
+    "docx.image.image",
+    "docx.opc.pkgwriter",
+    "lxml.etree",
+)
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)")
 MD_EXT = ".md"
 PY_EXT = ".py"
 PYX_EXT = ".pyx"
@@ -43,19 +127,413 @@ RS_EXT = ".rs"
 TOML_EXT = ".toml"
 TXT_EXT = ".txt"
 INI_EXT = ".ini"
-CODE_BLOCK_SPACING = Pt(10)
+CODE_BLOCK_SPACING = 10 * EMUS_PER_PT
 HEADING_BASE_SIZE = 26
 HEADING_SIZE_REDUCTION = 2
 ERROR_PY_NOT_FOUND = "[Python file not found: {}]"
 ERROR_MD_NOT_FOUND = "[Markdown file not found: {}]"
 ERROR_IMAGE_NOT_FOUND = "[Image not found: {}]"
+ERROR_IMAGE_UNSUPPORTED = "[Unsupported image format: {}]"
+ERROR_LINE_RANGE = "[Invalid line range: {}]"
+WARNING_INCLUDE_CYCLE = "Include cycle: {}"
+WARNING_DUPLICATE_INCLUDE = "{} is included again from {} and will be skipped"
 MAX_HEADING_LEVEL = 6
 CODE_EXTENSIONS = (PY_EXT, PYX_EXT, C_EXT, H_EXT, RS_EXT, TOML_EXT, TXT_EXT, INI_EXT)
 IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
-
-LISTING_COUNTER = 0
-FIGURE_COUNTER = 0
-REFERENCES: list[tuple[str, str]] = []
+IMAGE_DPI = 150
+# Чтение картинок упирается в задержку диска, а не в процессор
+IMAGE_PROBE_WORKERS = 32
+# python-docx определяет формат картинки по первым 32 байтам
+IMAGE_HEADER_BYTES = 32
+# Сколько картинок читается заранее, пока сборка встраивает предыдущие
+IMAGE_PREFETCH = 8
+IMAGE_UNSUPPORTED = "unsupported"
+IMAGE_JPEG_QUALITY = 85
+IMAGE_CACHE_DIR = "images"
+FRAGMENT_CACHE_DIR = ".md_to_docx_cache"
+BUILD_CACHE_DIR = "builds"
+DIST_INFO_EXT = ".dist-info"
+# Кэши ограничены: при переполнении удаляются давно не использованные записи
+BUILD_CACHE_ENTRIES = 8
+BUILD_CACHE_BYTES = 2 * 2**30
+FRAGMENT_CACHE_ENTRIES = 10000
+FRAGMENT_CACHE_BYTES = 256 * 2**20
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ACCESS_DATE_FORMAT = "%d.%m.%Y"
+LINK_PATTERN = re.compile(
+    r"\]\(\s*<?([^)\s>]+)>?[^)]*\)|^\s*\[[^\]]+\]:\s*<?([^\s>]+)"
+    r"|\bsrc=[\"']([^\"']+)[\"']",
+    re.MULTILINE,
+)
+CODE_FENCE_PATTERN = re.compile(r"(`{3,}|~{3,})")
+CODE_SPAN_PATTERN = re.compile(r"(`+)(?:[^`\n]|\n(?![ \t]*\n)|(?!\1)`+)+?\1(?!`)")
+LIST_ITEM_PATTERN = re.compile(r"\s*(?:[*+-]|\d+\.)\s")
+FRAGMENT_NAMESPACE = "urn:md-to-docx:fragment"
+INCLUDE_TAG = f"{{{FRAGMENT_NAMESPACE}}}include"
+IMAGE_TAG = f"{{{FRAGMENT_NAMESPACE}}}image"
+NUMBER_TOKEN_PATTERN = re.compile("\ue000([LFR])(\\d+)\ue001")
+LISTING_EVENT = "L"
+FIGURE_EVENT = "F"
+REFERENCE_EVENT = "R"
+INCLUDE_EVENT = "I"
+STAGE_CACHE = "cache"
+STAGE_MARKDOWN = "markdown"
+STAGE_PARSE = "parse"
+STAGE_HEADERS = "headers"
+STAGE_RENDER = "render"
+STAGE_IMAGES = "images"
+STAGE_SAVE = "save"
+PROFILE_STAGES = (
+    STAGE_CACHE,
+    STAGE_MARKDOWN,
+    STAGE_PARSE,
+    STAGE_HEADERS,
+    STAGE_RENDER,
+    STAGE_IMAGES,
+    STAGE_SAVE,
+)
+BACKEND_ETREE = "etree"
+BACKEND_BS4 = "bs4"
+MARKDOWN_BACKENDS = (BACKEND_ETREE, BACKEND_BS4)
+RUN_BREAK_PATTERN = re.compile("(\t|[\r\n])")
+BLOCK_HTML_PATTERN = re.compile(r"^<\/?([^ >]+)")
+
+
+class TreeText(str):
+    name = None
+
+
+class TreeElement:
+    # Обёртка над узлом дерева python-markdown с тем же интерфейсом,
+    # что использует рендеринг у узлов BeautifulSoup
+    def __init__(
+        self,
+        element: ElementTree.Element,
+        stash: list[str],
+        parent: ElementTree.Element | None = None,
+    ) -> None:
+        self.element = element
+        self.stash = stash
+        self.parent = parent
+
+    @property
+    def name(self) -> str:
+        return self.element.tag
+
+    @name.setter
+    def name(self, value: str) -> None:
+        self.element.tag = value
+
+    @property
+    def children(self) -> list:
+        return tree_children(self.element, self.stash)
+
+    def get(self, key: str, default: str | None = None) -> str | None:
+        value = self.element.get(key)
+        return default if value is None else tree_text(value, self.stash)
+
+    def get_text(self, strip: bool = False) -> str:
+        strings = self.strings()
+        if strip:
+            return "".join(string.strip() for string in strings if string.strip())
+        return "".join(strings)
+
+    def strings(self) -> list[str]:
+        strings = []
+        for node in self.children:
+            if isinstance(node, TreeElement):
+                strings.extend(node.strings())
+            elif node.name is None:
+                strings.append(str(node))
+            else:
+                strings.extend(node.strings)
+        return strings
+
+    def find(self, name) -> "TreeElement | None":
+        found = self.find_all(name, limit=1)
+        return found[0] if found else None
+
+    def find_all(
+        self, name, recursive: bool = True, limit: int | None = None
+    ) -> list["TreeElement"]:
+        found = []
+        if recursive:
+            pairs = iter_with_parent(self.element)
+        else:
+            pairs = ((self.element, child) for child in self.element)
+        for parent, child in pairs:
+            if tag_matches(child.tag, name):
+                found.append(TreeElement(child, self.stash, parent))
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def decompose(self) -> None:
+        element = self.element
+        if element.tail:
+            index = list(self.parent).index(element)
+            if index:
+                previous = self.parent[index - 1]
+                previous.tail = (previous.tail or "") + element.tail
+            else:
+                self.parent.text = (self.parent.text or "") + element.tail
+        self.parent.remove(element)
+
+    def __str__(self) -> str:
+        return str(bs4_element(self.element, self.stash))
+
+
+class ListingFile:
+    # Листинг отображается в память один раз за сборку; строки индексируются
+    # только до последней запрошенной, хвост ищется с конца файла. Отпечаток
+    # для кэша фрагментов - размер и время изменения отображённого файла:
+    # проверка фрагмента не читает листинг целиком
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.data = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if stat.st_size
+                else b""
+            )
+        self.fingerprint = f"{stat.st_size}:{stat.st_mtime_ns}"
+        self.line_starts = array("Q", [0])
+        self.indexed = 0
+
+    def lines(self, start: int, stop: int) -> bytes | None:
+        data = self.data
+        while len(self.line_starts) <= stop and self.indexed < len(data):
+            position = data.find(b"\n", self.indexed)
+            self.indexed = len(data) if position < 0 else position + 1
+            if position >= 0:
+                self.line_starts.append(self.indexed)
+        if start >= len(self.line_starts) or self.line_starts[start] >= len(data):
+            # Диапазон начинается за концом файла
+            return None
+        end = self.line_starts[stop] if stop < len(self.line_starts) else len(data)
+        return data[self.line_starts[start] : end]
+
+    def tail(self, count: int) -> bytes:
+        data = self.data
+        position = len(data) - 1 if data[-1:] == b"\n" else len(data)
+        for _ in range(count):
+            position = data.rfind(b"\n", 0, position)
+            if position < 0:
+                break
+        return data[position + 1 :]
+
+    def text(self, line_range: str = "") -> str | None:
+        content: bytes | None
+        if not line_range:
+            content = self.data[:]
+        elif match := LINE_RANGE_PATTERN.fullmatch(line_range):
+            first, last, window, count = match.groups()
+            if window == "head":
+                content = self.lines(0, int(count)) or b""
+            elif window == "tail":
+                content = self.tail(int(count))
+            elif int(first) < 1 or (last is not None and int(last) < int(first)):
+                return None
+            else:
+                content = self.lines(int(first) - 1, int(last or first))
+                if content is None:
+                    return None
+        else:
+            return None
+        # Те же переводы строк, что при чтении файла в текстовом режиме
+        return content.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+class ReferenceRegistry:
+    # Один номер на каждый URL в порядке первого цитирования. Состояние -
+    # список (текст, URL): он же хранится во фрагменте и при нумерации
+    # сливается с общим реестром добавлением по одной записи
+    def __init__(self) -> None:
+        self.entries: list[tuple[str, str]] = []
+        self.numbers: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.numbers
+
+    def add(self, link_text: str, url: str) -> int:
+        number = self.numbers.get(url)
+        if number is None:
+            self.entries.append((link_text, url))
+            number = self.numbers[url] = len(self.entries)
+        return number
+
+
+@dataclass
+class ImageProbe:
+    digest: str | None = None
+    size: int = 0
+    # Непроверенное начало файла, после check_image - None
+    header: bytes | None = None
+    error: str | None = None
+
+
+@dataclass
+class ParsedMarkdown:
+    soup: "BeautifulSoup | TreeElement"
+    h1: str | None
+
+
+@dataclass
+class Fragment:
+    h1: str | None = None
+    xml: str = ""
+    events: list[str] = field(default_factory=list)
+    listings: int = 0
+    figures: int = 0
+    # Путь картинки для каждого события FIGURE_EVENT по порядку
+    images: list[str] = field(default_factory=list)
+    references: list[tuple[str, str]] = field(default_factory=list)
+    includes: list[tuple[str, int, int, str]] = field(default_factory=list)
+    dependencies: dict[str, str | None] = field(default_factory=dict)
+
+
+@dataclass
+class FragmentInstance:
+    path: str
+    key: FragmentKey
+    fragment: Fragment
+    numbers: dict[str, list[int]]
+    children: list[tuple[Fragment, "FragmentInstance | None"]]
+
+
+FragmentKey = tuple[str, int, bool, bool]
+
+
+@dataclass
+class Block:
+    kind: str
+    text: str = ""
+    level: int = 0
+    caption: str = ""
+    path: str = ""
+    rows: list[list[str]] = field(default_factory=list)
+
+
+@dataclass
+class IncludeGraph:
+    root: str
+    # Ссылки каждого .md файла в порядке появления в тексте
+    edges: dict[str, list[str]] = field(default_factory=dict)
+    cycles: list[list[str]] = field(default_factory=list)
+    duplicates: list[tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def sources(self) -> list[str]:
+        return sorted({self.root, *chain.from_iterable(self.edges.values())})
+
+
+@dataclass
+class StageStats:
+    seconds: float = 0.0
+    peak_bytes: int = 0
+
+
+@dataclass
+class BuildProfile:
+    stats: dict[str, dict[str, StageStats]] = field(default_factory=dict)
+    root: FragmentInstance | None = None
+    output: str | None = None
+
+    @contextmanager
+    def stage(self, name: str, file_path: str):
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+            stats = self.stats.setdefault(file_path, {}).setdefault(name, StageStats())
+            stats.seconds += elapsed
+            stats.peak_bytes = max(stats.peak_bytes, peak_bytes)
+
+
+@dataclass
+class ConversionContext:
+    root_directory: str
+    cache_dir: str | None = None
+    listing_counter: int = 0
+    figure_counter: int = 0
+    references: ReferenceRegistry = field(default_factory=ReferenceRegistry)
+    parsed_markdown: dict[str, ParsedMarkdown] = field(default_factory=dict)
+    file_digests: dict[str, str | None] = field(default_factory=dict)
+    listing_files: dict[str, ListingFile | None] = field(default_factory=dict)
+    fragment_memory: dict[str, Fragment] | None = None
+    image_probes: dict[str, ImageProbe] = field(default_factory=dict)
+    fragment: Fragment = field(default_factory=Fragment)
+    fragment_references: ReferenceRegistry = field(default_factory=ReferenceRegistry)
+    markdown_parser: markdown.Markdown | None = None
+    scratch_document: object | None = None
+    template: bytes | None = None
+    profile: BuildProfile | None = None
+    backend: str = BACKEND_BS4
+    image_sources: dict[str, str | io.BytesIO] = field(default_factory=dict)
+    image_prefetch: ImagePrefetch | None = None
+    embedded_images: dict[str, tuple] = field(default_factory=dict)
+    next_shape_id: int | None = None
+    style_ids: dict[str, str | None] = field(default_factory=dict)
+    writer: "StreamingDocxWriter | None" = None
+    spill: FragmentSpill | None = None
+    access_date: str = ""
+
+
+_WORKER_CONTEXT: ConversionContext | None = None
+W_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+W_P = f"{W_NAMESPACE}p"
+W_PPR = f"{W_NAMESPACE}pPr"
+W_PSTYLE = f"{W_NAMESPACE}pStyle"
+W_VAL = f"{W_NAMESPACE}val"
+W_T = f"{W_NAMESPACE}t"
+W_BR = f"{W_NAMESPACE}br"
+W_TAB = f"{W_NAMESPACE}tab"
+W_TBL = f"{W_NAMESPACE}tbl"
+W_TR = f"{W_NAMESPACE}tr"
+W_TC = f"{W_NAMESPACE}tc"
+
+
+def import_dependencies() -> None:
+    # markdown, bs4, python-docx и lxml загружаются при первой сборке, а не
+    # при запуске: --help, --deps и готовая сборка из кэша обходятся без них.
+    # Функции сборки импортируют нужное сами, здесь модули только прогреваются
+    import markdown
+
+    for module_name in DEPENDENCY_MODULES:
+        importlib.import_module(module_name)
+    # Расширения markdown импортируются, а их шаблоны компилируются только
+    # при создании парсера
+    markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    fragment_parser()
+    stash_patterns()
+
+
+@cache
+def fragment_parser():
+    from docx.oxml.parser import element_class_lookup
+    from lxml import etree
+
+    # Отдельный парсер для больших фрагментов: после разбора большого документа
+    # общим парсером python-docx каждый мелкий parse_xml в нём заметно замедляется
+    parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
+    parser.set_element_class_lookup(element_class_lookup)
+    return parser
+
+
+@cache
+def stash_patterns() -> tuple[re.Pattern, re.Pattern]:
+    # Метка сырого HTML и она же, занимающая целый абзац
+    from markdown.util import HTML_PLACEHOLDER
+
+    placeholder = HTML_PLACEHOLDER % "([0-9]+)"
+    return re.compile(placeholder), re.compile(f"<p>{placeholder}</p>|{placeholder}")
 
 
 def get_list_style(list_type: str, nesting_level: int) -> str:
@@ -78,6 +556,11 @@ def is_image_extension(filename: str) -> bool:
 
 
 def configure_document_style(document: Document) -> None:
+    from docx.enum.style import WD_STYLE_TYPE
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    from docx.shared import Emu, Pt, RGBColor
+
     style = document.styles["Normal"]
     font = style.font
     font.name = FONT_NAME
@@ -94,7 +577,7 @@ def configure_document_style(document: Document) -> None:
         heading_font = heading_style.font
         heading_font.name = FONT_NAME
         heading_font.size = Pt(HEADING_BASE_SIZE - level * HEADING_SIZE_REDUCTION)
-        heading_font.color.rgb = HEADING_COLOR
+        heading_font.color.rgb = RGBColor(*HEADING_COLOR)
         heading_font.bold = True if level <= 3 else False
 
         rPr = heading_style.element.rPr
@@ -122,10 +605,10 @@ def configure_document_style(document: Document) -> None:
     code_style.paragraph_format.first_line_indent = CODE_FIRST_LINE_INDENT
 
     for section in document.sections:
-        section.top_margin = TOP_MARGIN
-        section.bottom_margin = BOTTOM_MARGIN
-        section.left_margin = LEFT_MARGIN
-        section.right_margin = RIGHT_MARGIN
+        section.top_margin = Emu(TOP_MARGIN)
+        section.bottom_margin = Emu(BOTTOM_MARGIN)
+        section.left_margin = Emu(LEFT_MARGIN)
+        section.right_margin = Emu(RIGHT_MARGIN)
 
     section = document.sections[0]
     footer = section.footer
@@ -138,28 +621,111 @@ def configure_document_style(document: Document) -> None:
     document.sections[0].first_page_footer.paragraphs[0].text = ""
 
 
-def add_footnote_reference(paragraph, link_text: str, url: str) -> None:
-    global REFERENCES
+def number_token(event: str, number: int) -> str:
+    return f"\ue000{event}{number}\ue001"
+
+
+def create_document_template() -> bytes:
+    import docx
+
+    document = docx.Document()
+    configure_document_style(document)
+    stream = io.BytesIO()
+    document.save(stream)
+    return stream.getvalue()
+
+
+def new_document(template: bytes | None = None) -> Document:
+    import docx
+
+    if template is not None:
+        return docx.Document(io.BytesIO(template))
+    document = docx.Document()
+    configure_document_style(document)
+    return document
+
+
+def parse_fragment_xml(xml: str):
+    from lxml import etree
+
+    return etree.fromstring(xml, fragment_parser())
+
+
+def body_end(document: Document):
+    # w:sectPr всегда последний в w:body, новые блоки вставляются перед ним
+    # без поиска по телу документа, как это делает python-docx
+    return document.element.body[-1]
+
+
+def style_id(context: ConversionContext, document: Document, name: str) -> str | None:
+    # Поиск стиля по имени в python-docx каждый раз перебирает все стили,
+    # а у документов одной сборки они общие
+    from docx.enum.style import WD_STYLE_TYPE
+
+    if name not in context.style_ids:
+        context.style_ids[name] = document.part.get_style_id(
+            name, WD_STYLE_TYPE.PARAGRAPH
+        )
+    return context.style_ids[name]
+
 
-    REFERENCES.append((link_text, url))
-    ref_number = len(REFERENCES)
+def add_paragraph(
+    context: ConversionContext,
+    document: Document,
+    text: str = "",
+    style: str | None = None,
+) -> Paragraph:
+    from docx.oxml import OxmlElement
+    from docx.text.paragraph import Paragraph
+
+    p = OxmlElement("w:p")
+    body_end(document).addprevious(p)
+    paragraph = Paragraph(p, document._body)
+    if text:
+        paragraph.add_run(text)
+    if style is not None:
+        p.style = style_id(context, document, style)
+    return paragraph
+
+
+def add_heading(
+    context: ConversionContext, document: Document, text: str, level: int
+) -> Paragraph:
+    return add_paragraph(context, document, text, f"Heading {level}")
+
+
+def add_footnote_reference(
+    context: ConversionContext, paragraph, link_text: str, url: str
+) -> None:
+    # Событие нумерации только у первой ссылки на URL, повторы берут её номер
+    if url not in context.fragment_references:
+        context.fragment.events.append(REFERENCE_EVENT)
+    local_number = context.fragment_references.add(link_text, url)
+    ref_number = number_token(REFERENCE_EVENT, local_number)
 
     paragraph.add_run(f"{link_text}")
 
     run = paragraph.add_run(f"[{ref_number}]")
     run.font.superscript = True
-    run.font.size = Pt(13)
+    run.font.size = 13 * EMUS_PER_PT
 
 
-def format_heading(heading, level: int, document) -> None:
+def format_heading(
+    context: ConversionContext, heading, level: int, document: Document
+) -> None:
+    from docx.shared import Pt, RGBColor
+
     for run in heading.runs:
         run.font.name = FONT_NAME
         run.font.size = Pt(HEADING_BASE_SIZE - level * HEADING_SIZE_REDUCTION)
-        run.font.color.rgb = HEADING_COLOR
-        heading.style = document.styles[f"Heading {level}"]
+        run.font.color.rgb = RGBColor(*HEADING_COLOR)
+        heading._p.style = style_id(context, document, f"Heading {level}")
 
 
 def add_border_to_paragraph(paragraph) -> None:
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
     pPr = paragraph._p.get_or_add_pPr()
     pBdr = OxmlElement("w:pBdr")
     for border_name in ["w:top", "w:left", "w:bottom", "w:right"]:
@@ -173,122 +739,218 @@ def add_border_to_paragraph(paragraph) -> None:
 
 
 def insert_code_block(
+    context: ConversionContext,
     document: Document,
     code_content: str,
     description: str | None = None,
 ) -> None:
-    global LISTING_COUNTER
-    LISTING_COUNTER += 1
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from docx.oxml.ns import nsdecls
 
-    caption = document.add_paragraph()
+    context.fragment.listings += 1
+    context.fragment.events.append(LISTING_EVENT)
+
+    caption = add_paragraph(context, document)
     caption.alignment = WD_ALIGN_PARAGRAPH.LEFT
-    caption.paragraph_format.first_line_indent = Cm(0)
-    listing_text = f"Листинг {LISTING_COUNTER}"
+    caption.paragraph_format.first_line_indent = 0
+    listing_text = (
+        f"{LISTING_CAPTION} {number_token(LISTING_EVENT, context.fragment.listings)}"
+    )
     if description:
         listing_text += f" - {description}"
     run = caption.add_run(listing_text)
     run.font.name = FONT_NAME
     run.font.size = FONT_SIZE
 
-    paragraph = document.add_paragraph(style="Code")
-    run = paragraph.add_run(code_content.rstrip())
+    paragraph = add_paragraph(context, document, style="Code")
+    # Длинный листинг разбивается на несколько прогонов по LISTING_RUN_LINES строк
+    lines = code_content.rstrip().split("\n")
+    for start in range(0, len(lines), LISTING_RUN_LINES):
+        text = "\n".join(lines[start : start + LISTING_RUN_LINES])
+        if start + LISTING_RUN_LINES < len(lines):
+            text += "\n"
+        paragraph._p.extend(
+            parse_fragment_xml(
+                f"<w:p {nsdecls('w')}><w:r>{run_content_xml(text)}</w:r></w:p>"
+            )
+        )
     add_border_to_paragraph(paragraph)
 
 
 def insert_image(
+    context: ConversionContext,
     document: Document,
     image_path: str,
     description: str = "Изображение",
-    width: Inches = IMAGE_WIDTH,
+    width: int = IMAGE_WIDTH,
 ) -> None:
-    global FIGURE_COUNTER
-    if not os.path.exists(image_path):
-        document.add_paragraph(ERROR_IMAGE_NOT_FOUND.format(image_path))
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    from lxml import etree
+
+    context.fragment.dependencies[image_path] = file_fingerprint(context, image_path)
+    error = image_probe(context, image_path).error
+    if error is not None:
+        add_paragraph(context, document, error.format(image_path))
         return
 
-    FIGURE_COUNTER += 1
+    context.fragment.figures += 1
+    context.fragment.events.append(FIGURE_EVENT)
+    context.fragment.images.append(image_path)
 
-    paragraph = document.add_paragraph()
-    paragraph.paragraph_format.first_line_indent = Cm(0)
+    paragraph = add_paragraph(context, document)
+    paragraph.paragraph_format.first_line_indent = 0
     run = paragraph.add_run()
-    run.add_picture(image_path, width=width)
+    # Картинка встраивается при сборке документа, во фрагменте только метка
+    run._r.append(etree.Element(IMAGE_TAG, path=image_path, width=str(int(width))))
     paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
 
-    caption = document.add_paragraph()
+    caption = add_paragraph(context, document)
     caption.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    caption.paragraph_format.first_line_indent = Cm(0)
-    run = caption.add_run(f"Рисунок {FIGURE_COUNTER} - {description}\n")
+    caption.paragraph_format.first_line_indent = 0
+    figure_number = number_token(FIGURE_EVENT, context.fragment.figures)
+    run = caption.add_run(f"{FIGURE_CAPTION} {figure_number} - {description}\n")
     run.italic = True
     run.font.name = FONT_NAME
     run.font.size = FIGURE_FONT_SIZE
 
 
-def insert_table(document: Document, table_html: str) -> None:
-    soup = BeautifulSoup(table_html, "html.parser")
-    table = soup.find("table")
-    if not table:
-        return
+def run_content_xml(text: str) -> str:
+    # То же разбиение, что делает python-docx при присваивании run.text
+    parts = []
+    for index, chunk in enumerate(RUN_BREAK_PATTERN.split(text)):
+        if index % 2:
+            parts.append("<w:tab/>" if chunk == "\t" else "<w:br/>")
+        elif chunk:
+            space = ' xml:space="preserve"' if chunk.strip() != chunk else ""
+            parts.append(f"<w:t{space}>{html.escape(chunk, quote=False)}</w:t>")
+    return "".join(parts)
+
+
+def table_row_xml(cells: list[tuple[str, bool]], num_cols: int, tc_pr: str) -> str:
+    tcs = []
+    for text, bold in cells:
+        r_pr = "<w:rPr><w:b/></w:rPr>" if bold else ""
+        content = run_content_xml(text)
+        run = f"<w:r>{r_pr}{content}</w:r>" if r_pr or content else "<w:r/>"
+        tcs.append(f"<w:tc>{tc_pr}<w:p>{run}</w:p></w:tc>")
+    tcs.extend(f"<w:tc>{tc_pr}<w:p/></w:tc>" for _ in range(num_cols - len(cells)))
+    return f"<w:tr>{''.join(tcs)}</w:tr>"
+
+
+def insert_table_rows(
+    document: Document,
+    rows: Iterable[list[tuple[str, bool]]],
+    num_cols: int,
+) -> None:
+    from docx.oxml.ns import nsdecls
+    from docx.shared import Emu
+
+    # Строки таблицы собираются в XML пачками, без обращений к rows[i].cells[j]
+    col_width = Emu(document._block_width // num_cols if num_cols else 0)
+    tc_pr = f'<w:tcPr><w:tcW w:type="dxa" w:w="{col_width.twips}"/></w:tcPr>'
+    grid = f'<w:gridCol w:w="{col_width.twips}"/>' * num_cols
+    style_id = document.styles[TABLE_STYLE].style_id
+    header = (
+        f'<w:tblPr><w:tblStyle w:val="{style_id}"/><w:tblW w:type="auto" w:w="0"/>'
+        '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0"'
+        ' w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+        f"<w:tblGrid>{grid}</w:tblGrid>"
+    )
+
+    rows = iter(rows)
+    table = None
+    while True:
+        chunk = "".join(
+            table_row_xml(cells, num_cols, tc_pr)
+            for cells in islice(rows, TABLE_CHUNK_ROWS)
+        )
+        if table is None:
+            table = parse_fragment_xml(f"<w:tbl {nsdecls('w')}>{header}{chunk}</w:tbl>")
+            body_end(document).addprevious(table)
+        elif chunk:
+            table.extend(parse_fragment_xml(f"<w:tbl {nsdecls('w')}>{chunk}</w:tbl>"))
+        if not chunk:
+            break
+
 
+def insert_table(document: Document, table) -> None:
     rows = table.find_all("tr")
     if not rows:
         return
 
-    num_rows = len(rows)
-    num_cols = max(len(row.find_all(["td", "th"])) for row in rows)
-    doc_table = document.add_table(rows=num_rows, cols=num_cols)
-    doc_table.style = TABLE_STYLE
+    row_cells = [row.find_all(["td", "th"]) for row in rows]
+    num_cols = max(len(cells) for cells in row_cells)
+    insert_table_rows(
+        document,
+        (
+            [(cell.get_text(strip=True), cell.name == "th") for cell in cells]
+            for cells in row_cells
+        ),
+        num_cols,
+    )
 
-    for i, row in enumerate(rows):
-        cells = row.find_all(["td", "th"])
-        for j, cell in enumerate(cells):
-            cell_text = cell.get_text(strip=True)
-            doc_table.rows[i].cells[j].text = cell_text
-            if cell.name == "th":
-                for paragraph in doc_table.rows[i].cells[j].paragraphs:
-                    for run in paragraph.runs:
-                        run.font.bold = True
+
+def add_include(
+    context: ConversionContext,
+    document: Document,
+    md_path: str,
+    level: int,
+    level_increase: int,
+    link_text: str,
+) -> None:
+    from lxml import etree
+
+    context.fragment.includes.append((md_path, level, level_increase, link_text))
+    context.fragment.events.append(INCLUDE_EVENT)
+    marker = etree.Element(INCLUDE_TAG, index=str(len(context.fragment.includes) - 1))
+    body_end(document).addprevious(marker)
 
 
 def handle_link(
+    context: ConversionContext,
     href: str,
     base_path: str,
     document: Document,
     paragraph,
-    root_directory: str,
     level_increase: int,
-    processed_files: set[str],
     link_text: str,
     heading_level: int | None = None,
 ) -> bool:
-    if is_code_extension(href):
-        py_path = os.path.normpath(os.path.join(base_path, href))
-        if os.path.exists(py_path):
-            with open(py_path, "r", encoding="utf-8") as f:
-                code_content = f.read()
-            insert_code_block(document, code_content, description=link_text)
-        else:
+    # Внешний адрес становится источником, даже если оканчивается на .py или .md
+    if urlparse(href).scheme:
+        add_footnote_reference(context, paragraph, link_text, href)
+        return True
+    code_href, _, line_range = href.partition("#")
+    if is_code_extension(code_href):
+        py_path = os.path.normpath(os.path.join(base_path, code_href))
+        context.fragment.dependencies[py_path] = file_fingerprint(context, py_path)
+        source = listing_file(context, py_path)
+        code_content = None if source is None else source.text(line_range)
+        if source is None:
             paragraph.add_run(ERROR_PY_NOT_FOUND.format(href))
+        elif code_content is None:
+            paragraph.add_run(ERROR_LINE_RANGE.format(href))
+        else:
+            insert_code_block(context, document, code_content, description=link_text)
         return True
     elif href.endswith(MD_EXT):
         md_path = os.path.normpath(os.path.join(base_path, href))
+        context.fragment.dependencies[md_path] = file_fingerprint(context, md_path)
         if os.path.exists(md_path):
-            heading_text = extract_h1_from_markdown(md_path, link_text)
             new_level = (
                 heading_level if heading_level is not None else level_increase + 1
             )
             new_level = min(new_level, MAX_HEADING_LEVEL)
-            heading = document.add_heading(heading_text, level=new_level)
-            format_heading(heading, new_level, document)
             adjusted_level_increase = (
                 new_level - 1 if heading_level is not None else level_increase
             )
-            process_markdown(
-                md_path,
-                root_directory,
+            add_include(
+                context,
                 document,
-                level_increase=adjusted_level_increase,
-                skip_h1=True,
-                processed_files=processed_files,
+                md_path,
+                new_level,
+                adjusted_level_increase,
+                link_text,
             )
         else:
             paragraph.add_run(ERROR_MD_NOT_FOUND.format(href))
@@ -296,66 +958,338 @@ def handle_link(
     elif is_image_extension(href):
         image_path = os.path.normpath(os.path.join(base_path, href))
         description = link_text
-        insert_image(document, image_path, description)
+        insert_image(context, document, image_path, description)
         return True
     elif href:
-        add_footnote_reference(paragraph, link_text, href)
+        add_footnote_reference(context, paragraph, link_text, href)
         return True
     return False
 
 
-def extract_h1_from_markdown(
-    file_path: str, fallback_text: str | None = None,
-) -> str:
+def profile_stage(context: ConversionContext, name: str, file_path: str):
+    if context.profile is None:
+        return nullcontext()
+    return context.profile.stage(name, file_path)
+
+
+def get_markdown(context: ConversionContext) -> markdown.Markdown:
+    import markdown
+
+    if context.markdown_parser is None:
+        context.markdown_parser = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return context.markdown_parser.reset()
+
+
+def markdown_tree(md: markdown.Markdown, source: str) -> ElementTree.Element:
+    # Те же шаги, что в Markdown.convert, но без сериализации в HTML. Это
+    # внутренности python-markdown, а не его API, поэтому бэкенд etree не по
+    # умолчанию: разбор быстрее в 2.6 раза, но на всю сборку это не влияет
+    if not source.strip():
+        return ElementTree.Element(md.doc_tag)
+    md.lines = source.split("\n")
+    for preprocessor in md.preprocessors:
+        md.lines = preprocessor.run(md.lines)
+    root = md.parser.parseDocument(md.lines).getroot()
+    for treeprocessor in md.treeprocessors:
+        new_root = treeprocessor.run(root)
+        if new_root is not None:
+            root = new_root
+    return root
+
+
+def iter_with_parent(element: ElementTree.Element):
+    for child in element:
+        yield element, child
+        yield from iter_with_parent(child)
+
+
+def tag_matches(tag: str, name) -> bool:
+    if isinstance(name, str):
+        return tag == name
+    if isinstance(name, re.Pattern):
+        return name.search(tag) is not None
+    return tag in name
+
+
+def is_block_html(raw_html: str) -> bool:
+    from markdown.util import BLOCK_LEVEL_ELEMENTS
+
+    match = BLOCK_HTML_PATTERN.match(raw_html)
+    if not match:
+        return False
+    tag = match[1]
+    return tag[0] in "!?@%" or tag.lower().rstrip("/") in BLOCK_LEVEL_ELEMENTS
+
+
+def restore_stash(text: str, stash: list[str]) -> str:
+    # Повторяет RawHtmlPostprocessor и AMP_SUBSTITUTE из python-markdown
+    from markdown.util import AMP_SUBSTITUTE
+
+    stash_pattern = stash_patterns()[1]
+
+    def substitute(match: re.Match) -> str:
+        index = int(match[1] or match[2])
+        if index >= len(stash):
+            return match[0]
+        raw_html = stash[index]
+        if match[2] or is_block_html(raw_html):
+            return stash_pattern.sub(substitute, raw_html)
+        return stash_pattern.sub(substitute, f"<p>{raw_html}</p>")
+
+    return stash_pattern.sub(substitute, text).replace(AMP_SUBSTITUTE, "&")
+
+
+def tree_text(text: str, stash: list[str]) -> str:
+    # Текст в том виде, в каком его вернул бы html.parser после сериализации
+    if "&" in text:
+        from markdown.serializers import RE_AMP
+
+        text = RE_AMP.sub("&amp;", text)
+    if "\x02" in text:
+        text = restore_stash(text, stash)
+    if "&" in text:
+        text = html.unescape(text)
+    return text
+
+
+def has_raw_markup(text: str | None, stash: list[str]) -> bool:
+    if not text or "\x02" not in text:
+        return False
+    return any(
+        "<" in stash[int(match[1])]
+        for match in stash_patterns()[0].finditer(text)
+        if int(match[1]) < len(stash)
+    )
+
+
+def block_stash(element: ElementTree.Element, stash: list[str]) -> str | None:
+    if element.tag != "p" or len(element) or not element.text:
+        return None
+    match = stash_patterns()[0].fullmatch(element.text)
+    if not match or int(match[1]) >= len(stash):
+        return None
+    raw_html = stash[int(match[1])]
+    return restore_stash(raw_html, stash) if is_block_html(raw_html) else None
+
+
+def bs4_element(element: ElementTree.Element, stash: list[str]):
+    from bs4 import BeautifulSoup
+    from markdown.serializers import to_html_string
+
+    tail = element.tail
+    element.tail = None
+    try:
+        element_html = to_html_string(element)
+    finally:
+        element.tail = tail
+    soup = BeautifulSoup(restore_stash(element_html, stash), "html.parser")
+    return soup.contents[0]
+
+
+def tree_children(element: ElementTree.Element, stash: list[str]) -> list:
+    # Встроенный сырой HTML разбирается html.parser только внутри своего узла
+    from bs4 import BeautifulSoup
+
+    if has_raw_markup(element.text, stash) or any(
+        has_raw_markup(child.tail, stash) for child in element
+    ):
+        return list(bs4_element(element, stash).children)
+
+    nodes = []
+    texts = []
+
+    def flush_text() -> None:
+        text = "".join(texts)
+        texts.clear()
+        if text:
+            nodes.append(TreeText(text))
+
+    if element.text:
+        texts.append(tree_text(element.text, stash))
+    for child in element:
+        raw_html = block_stash(child, stash)
+        if raw_html is None:
+            flush_text()
+            nodes.append(TreeElement(child, stash, element))
+        else:
+            for node in BeautifulSoup(raw_html, "html.parser").contents:
+                if node.name is None:
+                    texts.append(str(node))
+                else:
+                    flush_text()
+                    nodes.append(node)
+        if child.tail:
+            texts.append(tree_text(child.tail, stash))
+    flush_text()
+    return nodes
+
+
+def parse_markdown(context: ConversionContext, file_path: str) -> ParsedMarkdown:
+    from bs4 import BeautifulSoup
+
+    parsed = context.parsed_markdown.get(file_path)
+    if parsed is not None:
+        return parsed
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        markdown_content = f.read()
+
+    if context.backend == BACKEND_ETREE:
+        with profile_stage(context, STAGE_MARKDOWN, file_path):
+            md = get_markdown(context)
+            root = markdown_tree(md, markdown_content)
+        soup = TreeElement(root, [str(block) for block in md.htmlStash.rawHtmlBlocks])
+    else:
+        with profile_stage(context, STAGE_MARKDOWN, file_path):
+            html_content = get_markdown(context).convert(markdown_content)
+        with profile_stage(context, STAGE_PARSE, file_path):
+            soup = BeautifulSoup(html_content, "html.parser")
+    h1 = soup.find("h1")
+    parsed = ParsedMarkdown(soup=soup, h1=h1.get_text() if h1 else None)
+    context.parsed_markdown[file_path] = parsed
+    return parsed
+
+
+def listing_file(context: ConversionContext, file_path: str) -> ListingFile | None:
+    if file_path not in context.listing_files:
+        try:
+            context.listing_files[file_path] = ListingFile(file_path)
+        except OSError:
+            context.listing_files[file_path] = None
+    return context.listing_files[file_path]
+
+
+def file_digest(context: ConversionContext, file_path: str) -> str | None:
+    # Хэш содержимого: по нему ключ сборки и имя документа не зависят от
+    # времени изменения файлов, например после свежего checkout
+    if file_path in context.file_digests:
+        return context.file_digests[file_path]
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            markdown_content = f.read()
-        if not markdown_content.strip():
-            return fallback_text or os.path.basename(file_path)
-        md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
-        html_content = md.convert(markdown_content)
-        soup = BeautifulSoup(html_content, "html.parser")
-        h1 = soup.find("h1")
-        return h1.get_text() if h1 else (fallback_text or os.path.basename(file_path))
-    except Exception:
-        return fallback_text or os.path.basename(file_path)
-
-
-def adjust_headers(html_content: str, level_increase: int) -> str:
-    soup = BeautifulSoup(html_content, "html.parser")
+        with open(file_path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+    except OSError:
+        digest = None
+    context.file_digests[file_path] = digest
+    return digest
+
+
+def file_fingerprint(context: ConversionContext, file_path: str) -> str | None:
+    # Связанные .md и картинки попадают во фрагмент только меткой,
+    # поэтому для него важно лишь их наличие, а не содержимое
+    if is_image_extension(file_path):
+        probe = image_probe(context, file_path)
+        if probe.error == ERROR_IMAGE_NOT_FOUND:
+            return None
+        return "" if probe.error is None else IMAGE_UNSUPPORTED
+    if file_path.endswith(MD_EXT):
+        return "" if os.path.exists(file_path) else None
+    if is_code_extension(file_path):
+        # Отпечаток листинга берётся у того же отображения, из которого он вставляется
+        source = listing_file(context, file_path)
+        return None if source is None else source.fingerprint
+    return file_digest(context, file_path)
+
+
+def read_image(image_path: str) -> ImageProbe:
+    # Содержимое картинки в памяти не держится: хэш считается потоком,
+    # а сам файл заново читается при встраивании
+    try:
+        with open(image_path, "rb") as f:
+            header = f.read(IMAGE_HEADER_BYTES)
+            f.seek(0)
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+            size = f.tell()
+    except OSError:
+        return ImageProbe(error=ERROR_IMAGE_NOT_FOUND)
+    return ImageProbe(digest=digest, size=size, header=header)
+
+
+def check_image(probe: ImageProbe) -> None:
+    # Заголовок проверяется отдельно от чтения: для ключа сборки нужен
+    # только хэш, а python-docx загружается лишь при настоящей сборке.
+    # Сигнатуры те же, по которым Image.from_file выбирает формат
+    from docx.image import SIGNATURES
+
+    if probe.header is None:
+        return
+    if not any(
+        probe.header[offset : offset + len(signature)] == signature
+        for _, offset, signature in SIGNATURES
+    ):
+        probe.error = ERROR_IMAGE_UNSUPPORTED
+    probe.header = None
+
+
+def add_image_probe(
+    context: ConversionContext, image_path: str, probe: ImageProbe
+) -> None:
+    context.image_probes[image_path] = probe
+    if probe.digest is not None:
+        context.file_digests[image_path] = probe.digest
+
+
+def image_probe(context: ConversionContext, image_path: str) -> ImageProbe:
+    # Без предварительного прохода (процессы пула) картинка читается здесь
+    if image_path not in context.image_probes:
+        add_image_probe(context, image_path, read_image(image_path))
+    probe = context.image_probes[image_path]
+    check_image(probe)
+    return probe
+
+
+def read_images(context: ConversionContext, image_paths: list[str]) -> None:
+    # Все картинки хэшируются заранее и параллельно, рендеринг и сборка
+    # документа берут их отпечатки из context.image_probes
+    pending = [path for path in image_paths if path not in context.image_probes]
+    with ThreadPoolExecutor(max_workers=IMAGE_PROBE_WORKERS) as executor:
+        for path, probe in zip(pending, executor.map(read_image, pending)):
+            add_image_probe(context, path, probe)
+
+
+def probe_images(context: ConversionContext, image_paths: list[str]) -> None:
+    probes = [context.image_probes[path] for path in image_paths]
+    with ThreadPoolExecutor(max_workers=IMAGE_PROBE_WORKERS) as executor:
+        list(executor.map(check_image, probes))
+    failed = [path for path in image_paths if image_probe(context, path).error]
+    if failed:
+        print(f"{len(failed)} linked images cannot be embedded:")
+        for path in failed:
+            print(f"  {context.image_probes[path].error.format(path)}")
+
+
+def adjust_headers(soup: BeautifulSoup, level_increase: int) -> None:
+    if not level_increase:
+        return
     for header in soup.find_all(re.compile("^h[1-6]$")):
         current_level = int(header.name[1])
         new_level = min(current_level + level_increase, MAX_HEADING_LEVEL)
         header.name = f"h{new_level}"
-    return str(soup)
 
 
 def process_list_element(
+    context: ConversionContext,
     list_element,
     document: Document,
     level_increase: int,
-    processed_files: set[str],
     list_type: str,
     nesting_level: int,
     markdown_file_path: str,
-    root_directory: str,
 ) -> None:
     for li in list_element.find_all("li", recursive=False):
         style_name = get_list_style(list_type, nesting_level)
-        paragraph = document.add_paragraph(style=style_name)
+        paragraph = add_paragraph(context, document, style=style_name)
 
         for child in li.children:
             if child.name == "a":
                 href = child.get("href", "")
                 link_text = child.get_text()
                 handled = handle_link(
+                    context,
                     href,
                     os.path.dirname(markdown_file_path),
                     document,
                     paragraph,
-                    root_directory,
                     level_increase,
-                    processed_files,
                     link_text,
                 )
                 if handled:
@@ -377,64 +1311,88 @@ def process_list_element(
                     os.path.join(os.path.dirname(markdown_file_path), img_src)
                 )
                 insert_image(
-                    document, img_path, description=child.get("alt", "Изображение")
+                    context,
+                    document,
+                    img_path,
+                    description=child.get("alt", "Изображение"),
                 )
             elif child.name == "ul":
                 process_list_element(
+                    context,
                     child,
                     document,
                     level_increase,
-                    processed_files,
                     list_type="bullet",
                     nesting_level=nesting_level + 1,
                     markdown_file_path=markdown_file_path,
-                    root_directory=root_directory,
                 )
             elif child.name == "ol":
                 process_list_element(
+                    context,
                     child,
                     document,
                     level_increase,
-                    processed_files,
                     list_type="number",
                     nesting_level=nesting_level + 1,
                     markdown_file_path=markdown_file_path,
-                    root_directory=root_directory,
                 )
             else:
                 paragraph.add_run(str(child))
 
 
 def process_markdown(
+    context: ConversionContext,
     markdown_file_path: str,
-    root_directory: str,
     document: Document,
     level_increase: int = 0,
     skip_h1: bool = False,
-    processed_files: set[str] | None = None,
-) -> None:
-    if processed_files is None:
-        processed_files = set()
-
-    if markdown_file_path in processed_files:
-        return
-    processed_files.add(markdown_file_path)
-
-    with open(markdown_file_path, "r", encoding="utf-8") as f:
-        markdown_content = f.read()
-
-    md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
-    html_content = md.convert(markdown_content)
-
-    soup = BeautifulSoup(html_content, "html.parser")
-
-    if skip_h1:
-        for h1 in soup.find_all("h1"):
-            h1.decompose()
-
-    html_content = adjust_headers(str(soup), level_increase)
-    soup = BeautifulSoup(html_content, "html.parser")
+    shift_headers: bool = True,
+) -> Fragment:
+    from lxml import etree
+
+    parsed = parse_markdown(context, markdown_file_path)
+    # Дерево меняется при рендеринге, повторно его использовать нельзя
+    del context.parsed_markdown[markdown_file_path]
+    soup = parsed.soup
+
+    with profile_stage(context, STAGE_HEADERS, markdown_file_path):
+        if skip_h1:
+            for h1 in soup.find_all("h1"):
+                h1.decompose()
+
+        if shift_headers:
+            adjust_headers(soup, level_increase)
+
+    context.fragment = Fragment(h1=parsed.h1)
+    context.fragment_references = ReferenceRegistry()
+    with profile_stage(context, STAGE_RENDER, markdown_file_path):
+        render_elements(
+            context,
+            soup,
+            document,
+            markdown_file_path,
+            level_increase,
+        )
 
+        # w:sectPr последний; удаление срезом, пока на элементы нет ссылок из
+        # Python, освобождает их сразу, без копирования поддеревьев lxml
+        body = document.element.body
+        chunks = [etree.tostring(element, encoding="unicode") for element in body[:-1]]
+        del body[:-1]
+    context.fragment.xml = (
+        f'<fragment xmlns="{FRAGMENT_NAMESPACE}">{"".join(chunks)}</fragment>'
+    )
+    context.fragment.references = context.fragment_references.entries
+    return context.fragment
+
+
+def render_elements(
+    context: ConversionContext,
+    soup: BeautifulSoup,
+    document: Document,
+    markdown_file_path: str,
+    level_increase: int,
+) -> None:
     for element in soup.children:
         if element.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
             level = int(element.name[1])
@@ -445,47 +1403,43 @@ def process_markdown(
                 if child.name == "a" and child.get("href", "").endswith(MD_EXT):
                     href = child.get("href", "")
                     link_text = child.get_text()
-                    paragraph = document.add_paragraph()
+                    paragraph = add_paragraph(context, document)
                     handled = handle_link(
+                        context,
                         href,
                         os.path.dirname(markdown_file_path),
                         document,
                         paragraph,
-                        root_directory,
                         level_increase,
-                        processed_files,
                         link_text,
                         heading_level=level,
                     )
                     if handled:
                         has_md_link = True
                         if paragraph.text:
-                            document.paragraphs[-1]._element.getparent().remove(
-                                document.paragraphs[-1]._element
-                            )
+                            paragraph._p.getparent().remove(paragraph._p)
                 else:
                     heading_text += (
                         str(child) if child.name is None else child.get_text()
                     )
 
             if heading_text or not has_md_link:
-                heading = document.add_heading(heading_text, level=level)
-                format_heading(heading, level, document)
+                heading = add_heading(context, document, heading_text, level)
+                format_heading(context, heading, level, document)
 
         elif element.name == "p":
-            paragraph = document.add_paragraph()
+            paragraph = add_paragraph(context, document)
             for child in element.children:
                 if child.name == "a":
                     href = child.get("href", "")
                     link_text = child.get_text()
                     handled = handle_link(
+                        context,
                         href,
                         os.path.dirname(markdown_file_path),
                         document,
                         paragraph,
-                        root_directory,
                         level_increase,
-                        processed_files,
                         link_text,
                     )
                     if handled:
@@ -507,190 +1461,1517 @@ def process_markdown(
                         os.path.join(os.path.dirname(markdown_file_path), img_src)
                     )
                     insert_image(
-                        document, img_path, description=child.get("alt", "Изображение")
+                        context,
+                        document,
+                        img_path,
+                        description=child.get("alt", "Изображение"),
                     )
                 else:
                     paragraph.add_run(str(child))
         elif element.name == "ul":
             process_list_element(
+                context,
                 element,
                 document,
                 level_increase,
-                processed_files,
                 list_type="bullet",
                 nesting_level=0,
                 markdown_file_path=markdown_file_path,
-                root_directory=root_directory,
             )
         elif element.name == "ol":
             process_list_element(
+                context,
                 element,
                 document,
                 level_increase,
-                processed_files,
                 list_type="number",
                 nesting_level=0,
                 markdown_file_path=markdown_file_path,
-                root_directory=root_directory,
             )
         elif element.name == "table":
-            insert_table(document, str(element))
+            insert_table(document, element)
         elif element.name == "pre":
             code = element.find("code")
             if code:
-                insert_code_block(document, code.get_text())
+                insert_code_block(context, document, code.get_text())
+
+
+def fragment_cache_key(context: ConversionContext, key: FragmentKey) -> str | None:
+    import markdown
+
+    markdown_file_path, level_increase, skip_h1, shift_headers = key
+    source_digest = file_digest(context, markdown_file_path)
+    if source_digest is None:
+        return None
+    payload = json.dumps(
+        [
+            file_digest(context, __file__),
+            markdown.__version__,
+            context.backend,
+            os.path.abspath(markdown_file_path),
+            level_increase,
+            skip_h1,
+            shift_headers,
+            source_digest,
+        ]
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def read_fragment(context: ConversionContext, cache_key: str) -> Fragment | None:
+    path = os.path.join(context.cache_dir, f"{cache_key}.json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        fragment = Fragment(**data)
+        # Время изменения отмечает последнее использование для prune_cache
+        os.utime(path)
+    except (OSError, ValueError, TypeError):
+        return None
+    fragment.references = [tuple(ref) for ref in fragment.references]
+    fragment.includes = [tuple(include) for include in fragment.includes]
+    return fragment
+
+
+def load_fragment(context: ConversionContext, cache_key: str) -> Fragment | None:
+    fragment = None
+    if context.fragment_memory is not None:
+        fragment = context.fragment_memory.get(cache_key)
+    if fragment is None and context.cache_dir is not None:
+        fragment = read_fragment(context, cache_key)
+    if fragment is None:
+        return None
+
+    for path, fingerprint in fragment.dependencies.items():
+        if file_fingerprint(context, path) != fingerprint:
+            return None
+    if context.fragment_memory is not None:
+        context.fragment_memory[cache_key] = fragment
+        # Потоковая сборка очищает xml у фрагмента, в памяти остаётся оригинал
+        return replace(fragment)
+    return fragment
+
+
+def store_fragment(
+    context: ConversionContext, cache_key: str, fragment: Fragment
+) -> None:
+    if context.fragment_memory is not None:
+        context.fragment_memory[cache_key] = replace(fragment)
+    if context.cache_dir is None:
+        return
+    os.makedirs(context.cache_dir, exist_ok=True)
+    path = os.path.join(context.cache_dir, f"{cache_key}.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(asdict(fragment), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def include_key(include: tuple[str, int, int, str]) -> FragmentKey:
+    md_path, _, level_increase, _ = include
+    return md_path, level_increase, True, True
+
+
+def render_fragment(context: ConversionContext, key: FragmentKey) -> Fragment:
+    if context.scratch_document is None:
+        context.scratch_document = new_document(context.template)
+
+    markdown_file_path, level_increase, skip_h1, shift_headers = key
+    return process_markdown(
+        context,
+        markdown_file_path,
+        context.scratch_document,
+        level_increase=level_increase,
+        skip_h1=skip_h1,
+        shift_headers=shift_headers,
+    )
+
+
+def render_fragment_job(
+    key: FragmentKey, root_directory: str, backend: str
+) -> Fragment:
+    global _WORKER_CONTEXT
+    # Процесс пула выполняет задачи по одной, контекст можно переиспользовать
+    if (
+        _WORKER_CONTEXT is None
+        or _WORKER_CONTEXT.root_directory != root_directory
+        or _WORKER_CONTEXT.backend != backend
+    ):
+        _WORKER_CONTEXT = ConversionContext(
+            root_directory=root_directory, backend=backend
+        )
+    return render_fragment(_WORKER_CONTEXT, key)
 
 
-def add_references_section(document: Document) -> None:
-    if not REFERENCES:
-        return
+def process_pool(max_workers: int | None):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
 
-    heading = document.add_heading("Источники", level=1)
-    format_heading(heading, 1, document)
+    # Сервер запускает сборки из своих потоков, а fork переносит в дочерний
+    # процесс только вызывающий поток вместе с чужими занятыми блокировками.
+    # Процессы порождает forkserver с уже загруженными зависимостями
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("forkserver")
+        mp_context.set_forkserver_preload(list(DEPENDENCY_MODULES))
+    else:
+        mp_context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+
+
+def collect_fragments(
+    context: ConversionContext,
+    root_key: FragmentKey,
+    jobs: int = 1,
+) -> dict[FragmentKey, Fragment]:
+    fragments: dict[FragmentKey, Fragment] = {}
+    scheduled = {root_key}
+    pending = [root_key]
+    running = {}
+    use_cache = context.cache_dir is not None or context.fragment_memory is not None
+    used_keys = set()
+
+    def add_fragment(
+        key: FragmentKey, cache_key: str | None, fragment: Fragment
+    ) -> None:
+        if cache_key:
+            store_fragment(context, cache_key, fragment)
+        if context.spill is not None:
+            context.spill.add(key, fragment)
+        fragments[key] = fragment
+        for include in fragment.includes:
+            child_key = include_key(include)
+            if child_key not in scheduled:
+                scheduled.add(child_key)
+                pending.append(child_key)
+
+    executor = process_pool(jobs) if jobs > 1 else None
+    try:
+        while pending or running:
+            while pending:
+                key = pending.pop()
+                with profile_stage(context, STAGE_CACHE, key[0]):
+                    cache_key = fragment_cache_key(context, key) if use_cache else None
+                    fragment = load_fragment(context, cache_key) if cache_key else None
+                used_keys.add(cache_key)
+                if fragment is not None:
+                    add_fragment(key, None, fragment)
+                elif executor is None:
+                    add_fragment(key, cache_key, render_fragment(context, key))
+                else:
+                    future = executor.submit(
+                        render_fragment_job,
+                        key,
+                        context.root_directory,
+                        context.backend,
+                    )
+                    running[future] = key, cache_key
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, cache_key = running.pop(future)
+                    add_fragment(key, cache_key, future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if context.fragment_memory is not None:
+        # Фрагменты прежних версий изменённых глав больше не понадобятся
+        for cache_key in context.fragment_memory.keys() - used_keys:
+            del context.fragment_memory[cache_key]
+    if context.cache_dir is not None:
+        prune_cache(
+            context.cache_dir,
+            ".json",
+            FRAGMENT_CACHE_ENTRIES,
+            FRAGMENT_CACHE_BYTES,
+            keep=[f"{cache_key}.json" for cache_key in used_keys if cache_key],
+        )
+    return fragments
 
-    current_date = datetime.now().strftime("%d.%m.%Y")
-    for i, (link_text, url) in enumerate(REFERENCES, 1):
-        parsed_url = urlparse(url)
-        site_name = parsed_url.netloc if parsed_url.netloc else "Неизвестный сайт"
-        page_title = link_text if link_text else site_name
-        ref_text = f"[{i}] {page_title}. – URL: {url} (дата обращения: {current_date})."
-        paragraph = document.add_paragraph(ref_text)
-        paragraph.paragraph_format.first_line_indent = Cm(0)
 
+def number_fragment(
+    context: ConversionContext,
+    fragments: dict[FragmentKey, Fragment],
+    key: FragmentKey,
+    processed_files: set[str],
+) -> FragmentInstance:
+    fragment = fragments[key]
+    instance = FragmentInstance(
+        path=key[0],
+        key=key,
+        fragment=fragment,
+        numbers={LISTING_EVENT: [], FIGURE_EVENT: [], REFERENCE_EVENT: []},
+        children=[],
+    )
+    references = iter(fragment.references)
+    includes = iter(fragment.includes)
+    for event in fragment.events:
+        if event == LISTING_EVENT:
+            context.listing_counter += 1
+            instance.numbers[event].append(context.listing_counter)
+        elif event == FIGURE_EVENT:
+            context.figure_counter += 1
+            instance.numbers[event].append(context.figure_counter)
+        elif event == REFERENCE_EVENT:
+            instance.numbers[event].append(context.references.add(*next(references)))
+        elif event == INCLUDE_EVENT:
+            child_key = include_key(next(includes))
+            child = None
+            if child_key[0] not in processed_files:
+                processed_files.add(child_key[0])
+                child = number_fragment(context, fragments, child_key, processed_files)
+            instance.children.append((fragments[child_key], child))
+    return instance
+
+
+def optimize_image(
+    image_path: str, size: int, digest: str, cache_dir: str | None
+) -> str | io.BytesIO:
+    # Ширина в пикселях, которой хватает для IMAGE_WIDTH при IMAGE_DPI
+    target_width = round(IMAGE_WIDTH / EMUS_PER_INCH * IMAGE_DPI)
+    extension = os.path.splitext(image_path)[1].lower()
+    cached_path = None
+    if cache_dir is not None:
+        cached_path = os.path.join(
+            cache_dir, f"{digest}-{target_width}-{IMAGE_JPEG_QUALITY}{extension}"
+        )
+        if os.path.exists(cached_path):
+            return cached_path
 
-def convert_markdown_to_docx(root_directory: str, output_docx: str) -> None:
-    global REFERENCES
-    REFERENCES = []  # Очищаем список ссылок перед началом
+    from PIL import Image as PILImage
 
-    document = Document()
-    configure_document_style(document)
+    buffer = io.BytesIO()
+    with PILImage.open(image_path) as image:
+        if image.width > target_width:
+            target_height = max(1, round(image.height * target_width / image.width))
+            image = image.resize(
+                (target_width, target_height), PILImage.Resampling.LANCZOS
+            )
+        if extension == ".png":
+            image.save(buffer, "PNG", optimize=True)
+        else:
+            image.convert("RGB").save(
+                buffer, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True
+            )
+    # Пережатая картинка не меньше исходной: встраивается исходный файл
+    smaller = buffer.tell() < size
+    if cached_path is None:
+        if not smaller:
+            return image_path
+        buffer.seek(0)
+        return buffer
+    tmp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if smaller:
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getbuffer())
+    else:
+        shutil.copyfile(image_path, tmp_path)
+    os.replace(tmp_path, cached_path)
+    return cached_path
 
-    readme_path = os.path.join(root_directory, README_FILE)
 
-    if not os.path.exists(readme_path):
-        print(f"{README_FILE} not found!")
+def optimize_images(
+    context: ConversionContext, fragments: dict[FragmentKey, Fragment]
+) -> None:
+    if importlib.util.find_spec("PIL") is None:
+        print("Pillow is not installed, images are embedded as is")
         return
 
-    with open(readme_path, "r", encoding="utf-8") as f:
-        readme_content = f.read()
+    cache_dir = None
+    if context.cache_dir is not None:
+        cache_dir = os.path.join(context.cache_dir, IMAGE_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+    image_paths = sorted(
+        {
+            path
+            for fragment in fragments.values()
+            for path, fingerprint in fragment.dependencies.items()
+            if fingerprint == "" and is_image_extension(path)
+        }
+    )
+    probes = {path: image_probe(context, path) for path in image_paths}
+    with ThreadPoolExecutor() as executor:
+        futures = {
+            path: executor.submit(
+                optimize_image, path, probe.size, probe.digest, cache_dir
+            )
+            for path, probe in probes.items()
+            if probe.error is None
+        }
+    for path, future in futures.items():
+        context.image_sources[path] = future.result()
+
+
+def figure_paths(instance: FragmentInstance) -> Iterator[str]:
+    # Картинки в том порядке, в котором их встраивает splice_fragment
+    images = iter(instance.fragment.images)
+    children = iter(instance.children)
+    for event in instance.fragment.events:
+        if event == FIGURE_EVENT:
+            yield next(images)
+        elif event == INCLUDE_EVENT:
+            child = next(children)[1]
+            if child is not None:
+                yield from figure_paths(child)
+
+
+def load_image(source: str | io.BytesIO) -> io.BytesIO:
+    if isinstance(source, io.BytesIO):
+        return source
+    with open(source, "rb") as f:
+        return io.BytesIO(f.read())
+
+
+class ImagePrefetch:
+    # Картинки читаются пулом потоков не дальше IMAGE_PREFETCH файлов впереди
+    # встраивания: чтение не задерживает сборку, а в памяти только это окно
+    def __init__(self, context: ConversionContext, root: FragmentInstance) -> None:
+        self.context = context
+        self.pending = self.sources(root)
+        self.futures: dict[str, Future[io.BytesIO]] = {}
+        self.executor = ThreadPoolExecutor(max_workers=IMAGE_PREFETCH)
+        self.fill()
+
+    def sources(self, root: FragmentInstance) -> Iterator[tuple[str, str | io.BytesIO]]:
+        # Одинаковые по содержимому картинки встраиваются один раз, см. embed_image
+        seen = set()
+        for path in figure_paths(root):
+            digest = file_digest(self.context, path) or path
+            if digest not in seen:
+                seen.add(digest)
+                yield path, self.context.image_sources.pop(path, path)
+
+    def fill(self) -> None:
+        while len(self.futures) < IMAGE_PREFETCH:
+            item = next(self.pending, None)
+            if item is None:
+                return
+            path, source = item
+            self.futures[path] = self.executor.submit(load_image, source)
+
+    def take(self, image_path: str) -> io.BytesIO:
+        future = self.futures.pop(image_path, None)
+        self.fill()
+        if future is None:
+            return load_image(self.context.image_sources.pop(image_path, image_path))
+        return future.result()
+
+    def close(self) -> None:
+        self.executor.shutdown(cancel_futures=True)
+
+
+def embed_image(
+    context: ConversionContext, document: Document, image_path: str, width: int
+) -> CT_Inline:
+    from docx.oxml import CT_Inline
+    from docx.shared import Emu
+
+    # Одинаковые по содержимому картинки встраиваются в пакет один раз
+    digest = file_digest(context, image_path) or image_path
+    embedded = context.embedded_images.get(digest)
+    if embedded is None:
+        # Файл читается заранее и держится в памяти только до встраивания
+        source: str | io.BytesIO
+        if context.image_prefetch is not None:
+            source = context.image_prefetch.take(image_path)
+        else:
+            source = context.image_sources.pop(image_path, image_path)
+        if context.writer is not None:
+            rId, image = context.writer.add_image(source)
+        else:
+            rId, image = document.part.get_or_add_image(source)
+        # Сама картинка не хранится, только её размеры для масштабирования
+        embedded = rId, image.width, image.height
+        context.embedded_images[digest] = embedded
+    rId, image_width, image_height = embedded
+    # Тот же расчёт, что в Image.scaled_dimensions при заданной ширине
+    cx = Emu(width)
+    cy = Emu(round(image_height * (float(width) / float(image_width))))
+    # next_id обходит все @id документа, дальше номера выдаются по счётчику
+    if context.next_shape_id is None:
+        context.next_shape_id = document.part.next_id
+    shape_id = context.next_shape_id
+    context.next_shape_id += 1
+    return CT_Inline.new_pic_inline(shape_id, rId, os.path.basename(image_path), cx, cy)
+
+
+def fragment_root(context: ConversionContext, instance: FragmentInstance):
+    xml = instance.fragment.xml
+    if context.spill is not None:
+        xml = context.spill.read(instance.key)
+    xml = NUMBER_TOKEN_PATTERN.sub(
+        lambda match: str(instance.numbers[match[1]][int(match[2]) - 1]), xml
+    )
+    return parse_fragment_xml(xml)
+
+
+def include_heading(instance: FragmentInstance, index: int) -> tuple[str, int]:
+    md_path, level, _, link_text = instance.fragment.includes[index]
+    heading_text = instance.children[index][0].h1
+    if heading_text is None:
+        heading_text = link_text or os.path.basename(md_path)
+    return heading_text, level
+
+
+def splice_fragment(
+    context: ConversionContext, document: Document, instance: FragmentInstance
+) -> None:
+    with profile_stage(context, STAGE_RENDER, instance.path):
+        root = fragment_root(context, instance)
+    # Элементы забираются из корня по одному и без ссылок на них из Python:
+    # иначе удаление записанного элемента из тела копирует всё его поддерево
+    for _ in range(len(root)):
+        if root[0].tag == INCLUDE_TAG:
+            index = int(root[0].get("index"))
+            del root[0]
+            heading_text, level = include_heading(instance, index)
+            child = instance.children[index][1]
+            with profile_stage(context, STAGE_RENDER, instance.path):
+                heading = add_heading(context, document, heading_text, level)
+                format_heading(context, heading, level, document)
+            if child is not None:
+                splice_fragment(context, document, child)
+            continue
+
+        splice_element(context, document, instance, root[0])
+        if context.writer is not None:
+            context.writer.flush()
+
+
+def splice_element(
+    context: ConversionContext, document: Document, instance: FragmentInstance, element
+) -> None:
+    from docx.oxml import OxmlElement
+
+    with profile_stage(context, STAGE_RENDER, instance.path):
+        body_end(document).addprevious(element)
+    for marker in list(element.iter(IMAGE_TAG)):
+        with profile_stage(context, STAGE_IMAGES, instance.path):
+            inline = embed_image(
+                context, document, marker.get("path"), int(marker.get("width"))
+            )
+            drawing = OxmlElement("w:drawing")
+            drawing.append(inline)
+            marker.getparent().replace(marker, drawing)
 
-    md = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
-    html_content = md.convert(readme_content)
-    soup = BeautifulSoup(html_content, "html.parser")
 
-    processed_files = set()
-    current_heading_level = 1
+def paragraph_text(element) -> str:
+    parts = []
+    for node in element.iter(W_T, W_BR, W_TAB):
+        if node.tag == W_T:
+            parts.append(node.text or "")
+        else:
+            parts.append("\t" if node.tag == W_TAB else "\n")
+    return "".join(parts)
 
-    for element in soup.children:
-        if element.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-            level = int(element.name[1])
-            heading_text = ""
-            has_md_link = False
 
-            for child in element.children:
-                if child.name == "a" and child.get("href", "").endswith(MD_EXT):
-                    href = child.get("href", "")
-                    link_text = child.get_text()
-                    paragraph = document.add_paragraph()
-                    handled = handle_link(
-                        href,
-                        root_directory,
-                        document,
-                        paragraph,
-                        root_directory,
-                        current_heading_level,
-                        processed_files,
-                        link_text,
-                        heading_level=level,
-                    )
-                    if handled:
-                        has_md_link = True
-                        if paragraph.text:
-                            document.paragraphs[-1]._element.getparent().remove(
-                                document.paragraphs[-1]._element
-                            )
-                else:
-                    heading_text += (
-                        str(child) if child.name is None else child.get_text()
-                    )
+def paragraph_style(element) -> str:
+    style = element.find(f"{W_PPR}/{W_PSTYLE}")
+    return "" if style is None else style.get(W_VAL)
 
-            if heading_text or not has_md_link:
-                heading = document.add_heading(heading_text, level=level)
-                format_heading(heading, level, document)
 
-        elif element.name == "p":
-            paragraph = document.add_paragraph()
-            for child in element.children:
-                if child.name == "a":
-                    href = child.get("href", "")
-                    link_text = child.get_text()
-                    handled = handle_link(
-                        href,
-                        root_directory,
-                        document,
-                        paragraph,
-                        root_directory,
-                        current_heading_level,
-                        processed_files,
-                        link_text,
-                    )
-                    if handled:
-                        continue
-                    paragraph.add_run(link_text)
-                elif child.name == "strong":
-                    run = paragraph.add_run(child.get_text())
-                    run.bold = True
-                elif child.name == "em":
-                    run = paragraph.add_run(child.get_text())
-                    run.italic = True
-                elif child.name == "code":
-                    run = paragraph.add_run(child.get_text())
-                    run.font.name = CODE_FONT_NAME
-                    run.font.size = CODE_FONT_SIZE
-                elif child.name == "img":
-                    img_src = child.get("src", "")
-                    img_path = os.path.normpath(os.path.join(root_directory, img_src))
-                    insert_image(
-                        document, img_path, description=child.get("alt", "Изображение")
-                    )
-                else:
-                    paragraph.add_run(str(child))
-        elif element.name == "ul":
-            process_list_element(
-                element,
-                document,
-                current_heading_level,
-                processed_files,
-                list_type="bullet",
-                nesting_level=0,
-                markdown_file_path=readme_path,
-                root_directory=root_directory,
+def style_level(style: str, prefix: str) -> int:
+    suffix = style[len(prefix) :]
+    return int(suffix) if suffix.isdigit() else 1
+
+
+def fragment_blocks(
+    context: ConversionContext, instance: FragmentInstance, blocks: list[Block]
+) -> None:
+    for element in fragment_root(context, instance):
+        if element.tag == INCLUDE_TAG:
+            index = int(element.get("index"))
+            heading_text, level = include_heading(instance, index)
+            blocks.append(Block(BLOCK_HEADING, heading_text, level))
+            child = instance.children[index][1]
+            if child is not None:
+                fragment_blocks(context, child, blocks)
+        elif element.tag == W_TBL:
+            rows = [
+                [paragraph_text(cell) for cell in row.iter(W_TC)]
+                for row in element.iter(W_TR)
+            ]
+            blocks.append(Block(BLOCK_TABLE, rows=rows))
+        elif element.tag == W_P:
+            paragraph_block(element, blocks)
+
+
+def paragraph_block(element, blocks: list[Block]) -> None:
+    style = paragraph_style(element)
+    text = paragraph_text(element)
+    previous = blocks[-1] if blocks else None
+    image = next(element.iter(IMAGE_TAG), None)
+    if image is not None:
+        blocks.append(Block(BLOCK_FIGURE, path=image.get("path")))
+    elif style.startswith(HEADING_STYLE_PREFIX):
+        blocks.append(
+            Block(BLOCK_HEADING, text, style_level(style, HEADING_STYLE_PREFIX))
+        )
+    elif style == CODE_STYLE:
+        # Подпись листинга - отдельный абзац прямо перед кодом
+        caption = ""
+        if (
+            previous is not None
+            and previous.kind == BLOCK_PARAGRAPH
+            and previous.text.startswith(LISTING_CAPTION)
+        ):
+            caption = blocks.pop().text
+        blocks.append(Block(BLOCK_LISTING, text, caption=caption))
+    elif (
+        previous is not None
+        and previous.kind == BLOCK_FIGURE
+        and not previous.caption
+        and text.startswith(FIGURE_CAPTION)
+    ):
+        previous.caption = text.strip()
+    elif style.startswith(BULLET_STYLE_PREFIX):
+        blocks.append(
+            Block(BLOCK_BULLET, text, style_level(style, BULLET_STYLE_PREFIX))
+        )
+    elif style.startswith(NUMBER_STYLE_PREFIX):
+        blocks.append(
+            Block(BLOCK_NUMBER, text, style_level(style, NUMBER_STYLE_PREFIX))
+        )
+    elif text.strip():
+        blocks.append(Block(BLOCK_PARAGRAPH, text))
+
+
+def document_blocks(context: ConversionContext, root: FragmentInstance) -> list[Block]:
+    # Промежуточное представление строится по уже пронумерованным фрагментам,
+    # поэтому Markdown разбирается один раз для всех форматов
+    blocks: list[Block] = []
+    fragment_blocks(context, root, blocks)
+    if context.references:
+        blocks.append(Block(BLOCK_HEADING, REFERENCES_HEADING, 1))
+        blocks.extend(Block(BLOCK_REFERENCE, text) for text in reference_texts(context))
+    return blocks
+
+
+def html_block(block: Block, output_dir: str) -> str:
+    text = html.escape(block.text)
+    if block.kind == BLOCK_HEADING:
+        level = min(block.level, MAX_HEADING_LEVEL)
+        return f"<h{level}>{text}</h{level}>"
+    if block.kind == BLOCK_LISTING:
+        caption = html.escape(block.caption)
+        return (
+            f"<figure><figcaption>{caption}</figcaption>"
+            f"<pre><code>{text}</code></pre></figure>"
+        )
+    if block.kind == BLOCK_FIGURE:
+        src = html.escape(os.path.relpath(block.path, output_dir))
+        caption = html.escape(block.caption)
+        return (
+            f'<figure><img src="{src}" alt="{caption}">'
+            f"<figcaption>{caption}</figcaption></figure>"
+        )
+    if block.kind == BLOCK_TABLE:
+        rows = []
+        for index, row in enumerate(block.rows):
+            tag = "th" if index == 0 else "td"
+            cells = "".join(f"<{tag}>{html.escape(cell)}</{tag}>" for cell in row)
+            rows.append(f"<tr>{cells}</tr>")
+        return f"<table>{''.join(rows)}</table>"
+    return f"<p>{text}</p>".replace("\n", "<br>")
+
+
+def block_groups(blocks: list[Block]):
+    # Соседние пункты одного списка и уровня выводятся одним списком
+    for (kind, level), group in groupby(blocks, key=lambda b: (b.kind, b.level)):
+        if kind in (BLOCK_BULLET, BLOCK_NUMBER):
+            yield kind, level, list(group)
+        else:
+            for block in group:
+                yield kind, level, [block]
+
+
+def emit_html(blocks: list[Block], output_path: str) -> None:
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    title = next(
+        (block.text for block in blocks if block.kind == BLOCK_HEADING), README_FILE
+    )
+    parts = []
+    for kind, level, group in block_groups(blocks):
+        if kind in (BLOCK_BULLET, BLOCK_NUMBER):
+            tag = "ul" if kind == BLOCK_BULLET else "ol"
+            indent = f' style="margin-left: {2 * (level - 1)}em"' if level > 1 else ""
+            items = "".join(f"<li>{html.escape(block.text)}</li>" for block in group)
+            parts.append(f"<{tag}{indent}>{items}</{tag}>")
+        else:
+            parts.append(html_block(group[0], output_dir))
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(
+            HTML_DOCUMENT.format(
+                title=html.escape(title), style=HTML_STYLE, body="\n".join(parts)
             )
-        elif element.name == "ol":
-            process_list_element(
-                element,
-                document,
-                current_heading_level,
-                processed_files,
-                list_type="number",
-                nesting_level=0,
-                markdown_file_path=readme_path,
-                root_directory=root_directory,
+        )
+
+
+def text_block(block: Block) -> str:
+    if block.kind == BLOCK_HEADING:
+        underline = "=" if block.level == 1 else "-"
+        return f"{block.text}\n{underline * len(block.text)}"
+    if block.kind == BLOCK_LISTING:
+        code = "\n".join(f"    {line}" for line in block.text.split("\n"))
+        return f"{block.caption}\n\n{code}" if block.caption else code
+    if block.kind == BLOCK_FIGURE:
+        return f"[{block.caption or block.path}]"
+    if block.kind == BLOCK_TABLE:
+        return "\n".join(" | ".join(row) for row in block.rows)
+    return block.text
+
+
+def emit_text(blocks: list[Block], output_path: str) -> None:
+    parts = []
+    for kind, level, group in block_groups(blocks):
+        if kind in (BLOCK_BULLET, BLOCK_NUMBER):
+            indent = "  " * (level - 1)
+            parts.append(
+                "\n".join(
+                    f"{indent}{'-' if kind == BLOCK_BULLET else f'{number}.'} "
+                    f"{block.text}"
+                    for number, block in enumerate(group, 1)
+                )
             )
-        elif element.name == "table":
-            insert_table(document, str(element))
-        elif element.name == "pre":
-            code = element.find("code")
-            if code:
-                insert_code_block(document, code.get_text())
+        else:
+            parts.append(text_block(group[0]))
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(parts) + "\n")
+
+
+def emit_index(blocks: list[Block], output_path: str) -> None:
+    # Поисковый индекс: по записи на раздел с путём заголовков и его текстом
+    sections = []
+    titles: list[str] = []
+    texts: list[str] = []
+
+    def add_section() -> None:
+        if titles or texts:
+            sections.append(
+                {"path": list(titles), "text": "\n".join(filter(None, texts))}
+            )
+
+    for block in blocks:
+        if block.kind == BLOCK_HEADING:
+            add_section()
+            del titles[block.level - 1 :]
+            titles.append(block.text)
+            texts.clear()
+        elif block.kind == BLOCK_TABLE:
+            texts.extend(" ".join(row) for row in block.rows)
+        else:
+            texts.extend((block.caption, block.text))
+    add_section()
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(sections, f, ensure_ascii=False, indent=1)
+
+
+EMITTERS = {".html": emit_html, ".txt": emit_text, ".json": emit_index}
+
+
+def format_profile_report(profile: BuildProfile) -> str:
+    header = f"{'file':<48}" + "".join(f"{stage:>18}" for stage in PROFILE_STAGES)
+    lines = [header, "-" * len(header)]
+    totals = {stage: StageStats() for stage in PROFILE_STAGES}
+
+    def format_stats(stats: StageStats) -> str:
+        return f"{stats.seconds * 1000:>9.1f}ms{stats.peak_bytes / 1024:>7.0f}K"
+
+    def add_row(label: str, file_path: str) -> None:
+        stats = profile.stats.get(file_path, {})
+        cells = []
+        for stage in PROFILE_STAGES:
+            stage_stats = stats.get(stage)
+            if stage_stats is None:
+                cells.append(f"{'-':>18}")
+                continue
+            totals[stage].seconds += stage_stats.seconds
+            totals[stage].peak_bytes = max(
+                totals[stage].peak_bytes, stage_stats.peak_bytes
+            )
+            cells.append(format_stats(stage_stats))
+        if len(label) > 47:
+            label = "…" + label[-46:]
+        lines.append(f"{label:<48}" + "".join(cells))
+
+    def walk(instance: FragmentInstance, depth: int) -> None:
+        add_row("  " * depth + instance.path, instance.path)
+        for _, child in instance.children:
+            if child is not None:
+                walk(child, depth + 1)
+
+    if profile.root is not None:
+        walk(profile.root, 0)
+    if profile.output is not None:
+        add_row(profile.output, profile.output)
+
+    lines.append("-" * len(header))
+    lines.append(
+        f"{'total':<48}"
+        + "".join(format_stats(totals[stage]) for stage in PROFILE_STAGES)
+    )
+    return "\n".join(lines)
+
+
+def add_references_section(context: ConversionContext, document: Document) -> None:
+    if not context.references:
+        return
+
+    heading = add_heading(context, document, REFERENCES_HEADING, 1)
+    format_heading(context, heading, 1, document)
+
+    for ref_text in reference_texts(context):
+        paragraph = add_paragraph(context, document, ref_text)
+        paragraph.paragraph_format.first_line_indent = 0
 
-    add_references_section(document)
 
-    document.save(output_docx)
+def reference_texts(context: ConversionContext) -> list[str]:
+    texts = []
+    for i, (link_text, url) in enumerate(context.references.entries, 1):
+        parsed_url = urlparse(url)
+        site_name = parsed_url.netloc if parsed_url.netloc else "Неизвестный сайт"
+        page_title = link_text if link_text else site_name
+        texts.append(
+            f"[{i}] {page_title}. – URL: {url} (дата обращения: {context.access_date})."
+        )
+    return texts
+
+
+def zip_info(name: str) -> zipfile.ZipInfo:
+    # Фиксированные время и права делают архив побайтно воспроизводимым
+    info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def write_package(
+    archive: zipfile.ZipFile, document: Document, written: set[Part]
+) -> None:
+    # То же, что PackageWriter в python-docx, но без текущего времени в архиве
+    from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+    from docx.opc.pkgwriter import _ContentTypesItem
+
+    package = document.part.package
+    parts = list(package.iter_parts())
+    for part in parts:
+        part.before_marshal()
+    archive.writestr(
+        zip_info(CONTENT_TYPES_URI.membername),
+        _ContentTypesItem.from_parts(parts).blob,
+    )
+    archive.writestr(zip_info(PACKAGE_URI.rels_uri.membername), package.rels.xml)
+    for part in parts:
+        if part not in written:
+            archive.writestr(zip_info(part.partname.membername), part.blob)
+        if len(part.rels):
+            archive.writestr(zip_info(part.partname.rels_uri.membername), part.rels.xml)
+
+
+def save_document(document: Document, output_docx: str) -> None:
+    with zipfile.ZipFile(output_docx, "w") as archive:
+        write_package(archive, document, set())
+
+
+class StreamingDocxWriter:
+    # Тело word/document.xml по мере сборки уходит во временный файл, картинки
+    # сразу пишутся в архив, остальные части пакета - в конце. zipfile не даёт
+    # писать два элемента архива одновременно, поэтому тело копируется последним
+    def __init__(self, document: Document, output_docx: str) -> None:
+        from docx.opc.oxml import serialize_part_xml
+
+        self.document = document
+        self.image_count = 0
+        self.written_parts: set[Part] = {document.part}
+        self.archive = zipfile.ZipFile(output_docx, "w")
+        root = document.element
+        self.namespace_declarations = [
+            f' xmlns:{prefix}="{uri}"'.encode() for prefix, uri in root.nsmap.items()
+        ]
+
+        body = root.body
+        for element in list(body)[:-1]:
+            body.remove(element)
+        xml = serialize_part_xml(root)
+        body_start = xml.index(b"<w:body>") + len(b"<w:body>")
+        self.head = xml[:body_start]
+        self.tail = xml[body_start:]
+        self.body_file = tempfile.TemporaryFile()
+
+    def flush(self) -> None:
+        from lxml import etree
+
+        body = self.document.element.body
+        while len(body) > 1:
+            chunk = etree.tostring(body[0], encoding="UTF-8")
+            # Пространства имён уже объявлены в корне document.xml
+            tag_end = chunk.index(b">")
+            start_tag = chunk[:tag_end]
+            for declaration in self.namespace_declarations:
+                start_tag = start_tag.replace(declaration, b"")
+            self.body_file.write(start_tag + chunk[tag_end:])
+            del body[0]
+
+    def add_image(self, image_descriptor: str | io.BytesIO) -> tuple[str, Image]:
+        from docx.image.image import Image
+        from docx.opc.constants import RELATIONSHIP_TYPE as RT
+        from docx.opc.packuri import PackURI
+        from docx.opc.part import Part
+
+        image = Image.from_file(image_descriptor)
+        self.image_count += 1
+        partname = PackURI(f"/word/media/image{self.image_count}.{image.ext}")
+        self.archive.writestr(zip_info(partname.membername), image.blob)
+        part = Part(partname, image.content_type)
+        self.written_parts.add(part)
+        return self.document.part.relate_to(part, RT.IMAGE), image
+
+    def close(self) -> None:
+        self.flush()
+        self.body_file.seek(0)
+        with self.archive.open(
+            zip_info(self.document.part.partname.membername), "w", force_zip64=True
+        ) as stream:
+            stream.write(self.head)
+            shutil.copyfileobj(self.body_file, stream)
+            stream.write(self.tail)
+        self.body_file.close()
+        write_package(self.archive, self.document, self.written_parts)
+        self.archive.close()
+
+    def abort(self) -> None:
+        self.body_file.close()
+        self.archive.close()
+        os.remove(self.archive.filename)
+
+
+class FragmentSpill:
+    # При потоковой записи разметка собранных фрагментов ждёт своей очереди
+    # во временном файле: в памяти только раздел, который сейчас вставляется
+    def __init__(self) -> None:
+        self.file = tempfile.TemporaryFile()
+        self.spans: dict[FragmentKey, tuple[int, int]] = {}
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.file.close()
+
+    def add(self, key: FragmentKey, fragment: Fragment) -> None:
+        data = fragment.xml.encode("utf-8")
+        self.file.seek(0, os.SEEK_END)
+        self.spans[key] = self.file.tell(), len(data)
+        self.file.write(data)
+        fragment.xml = ""
+
+    def read(self, key: FragmentKey) -> str:
+        offset, size = self.spans[key]
+        self.file.seek(offset)
+        return self.file.read(size).decode("utf-8")
+
+
+def access_date() -> str:
+    # SOURCE_DATE_EPOCH фиксирует дату обращения к источникам для повторяемых сборок
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if epoch is None:
+        return datetime.now().strftime(ACCESS_DATE_FORMAT)
+    return datetime.fromtimestamp(int(epoch), timezone.utc).strftime(ACCESS_DATE_FORMAT)
+
+
+def strip_code(markdown_content: str) -> str:
+    # Ссылки в блоках и фрагментах кода при сборке не раскрываются. Вырезанные
+    # строки заменяются пустыми, чтобы определения ссылок остались в начале строк.
+    # Сдвинутые строки внутри списков считаются текстом: лишняя зависимость
+    # безопаснее пропущенной
+    source_lines = markdown_content.splitlines()
+    lines: list[str] = []
+    fence = None
+    fence_start = 0
+    indented_code = False
+    blank = True
+    in_list = False
+    for line in source_lines:
+        if fence is not None:
+            if line.rstrip() == fence:
+                fence = None
+            lines.append("")
+            continue
+        match = CODE_FENCE_PATTERN.match(line)
+        if match:
+            fence = match[1]
+            fence_start = len(lines)
+            lines.append("")
+            continue
+        indented = line.startswith(("    ", "\t"))
+        if indented_code and (indented or not line.strip()):
+            lines.append("")
+            continue
+        indented_code = indented and blank and not in_list
+        if indented_code:
+            lines.append("")
+            continue
+        if LIST_ITEM_PATTERN.match(line):
+            in_list = True
+        elif line.strip() and blank and not indented:
+            in_list = False
+        blank = not line.strip()
+        lines.append(line)
+    if fence is not None:
+        # Незакрытый блок Markdown считает обычным текстом
+        lines[fence_start:] = source_lines[fence_start:]
+    return CODE_SPAN_PATTERN.sub(
+        lambda match: "\n" * match[0].count("\n"), "\n".join(lines)
+    )
+
+
+def scan_links(markdown_file_path: str) -> list[str]:
+    # Файл может пропасть между проверкой и чтением (редактор сохраняет его
+    # подменой) или быть дописан не до конца. Ссылок у такого файла нет, а
+    # сборка или следящий режим заметят его по времени изменения
+    try:
+        with open(markdown_file_path, "r", encoding="utf-8") as f:
+            markdown_content = strip_code(f.read())
+    except (OSError, UnicodeDecodeError):
+        return []
+    return [
+        next(group for group in match.groups() if group)
+        for match in LINK_PATTERN.finditer(markdown_content)
+    ]
+
+
+def scan_includes(readme_path: str) -> IncludeGraph:
+    # Грубый поиск ссылок без разбора Markdown: лишний файл в зависимостях
+    # только сбросит кэш, а пропущенный отдал бы устаревший документ.
+    # Обход в глубину повторяет порядок, в котором number_fragment
+    # раскрывает вложенные файлы
+    readme_path = os.path.normpath(readme_path)
+    graph = IncludeGraph(root=readme_path)
+    stack: list[str] = []
+
+    def visit(markdown_file_path: str) -> None:
+        stack.append(markdown_file_path)
+        targets = graph.edges[markdown_file_path] = []
+        base_path = os.path.dirname(markdown_file_path)
+        for href in scan_links(markdown_file_path):
+            if urlparse(href).scheme:
+                continue
+            code_href = href.partition("#")[0]
+            if is_code_extension(code_href):
+                href = code_href
+            is_markdown = href.endswith(MD_EXT)
+            if not (is_markdown or is_code_extension(href) or is_image_extension(href)):
+                continue
+            path = os.path.normpath(os.path.join(base_path, href))
+            targets.append(path)
+            if not is_markdown or not os.path.exists(path):
+                continue
+            if path in stack:
+                cycle = stack[stack.index(path) :] + [path]
+                if cycle not in graph.cycles:
+                    graph.cycles.append(cycle)
+            elif path in graph.edges:
+                if (path, markdown_file_path) not in graph.duplicates:
+                    graph.duplicates.append((path, markdown_file_path))
+            else:
+                visit(path)
+        stack.pop()
+
+    visit(readme_path)
+    return graph
+
+
+def depfile_path_escape(path: str) -> str:
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def write_depfile(graph: IncludeGraph, output_docx: str, depfile: str) -> None:
+    # Формат gcc -MD -MP: понимают и make, и ninja (deps = gcc). Пустые
+    # правила для зависимостей не дают make упасть после удаления файла
+    dependencies = [
+        depfile_path_escape(path) for path in graph.sources if os.path.exists(path)
+    ]
+    lines = [f"{depfile_path_escape(output_docx)}: " + " \\\n  ".join(dependencies)]
+    lines.extend(f"\n{path}:" for path in dependencies)
+    with open(depfile, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def report_include_graph(graph: IncludeGraph) -> None:
+    for cycle in graph.cycles:
+        print(WARNING_INCLUDE_CYCLE.format(" -> ".join(cycle)))
+    for path, parent in graph.duplicates:
+        print(WARNING_DUPLICATE_INCLUDE.format(path, parent))
+
+
+def library_stamp(name: str) -> str | None:
+    # Переустановка библиотеки меняет время её файлов, импортировать её не нужно
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.origin is None:
+        return None
+    return f"{spec.origin}:{os.stat(spec.origin).st_mtime_ns}"
+
+
+def library_version(name: str, distribution: str) -> str | None:
+    # Версия берётся из имени каталога .dist-info рядом с пакетом: она одна на
+    # всех машинах, а importlib.metadata добавил бы к запуску десятки мс
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.origin is None:
+        return None
+    site_directory = os.path.dirname(os.path.dirname(spec.origin))
+    prefix = f"{distribution.lower().replace('-', '_')}-"
+    with suppress(OSError), os.scandir(site_directory) as scan:
+        for entry in scan:
+            entry_name = entry.name.lower()
+            if entry_name.startswith(prefix) and entry_name.endswith(DIST_INFO_EXT):
+                return entry.name[len(prefix) : -len(DIST_INFO_EXT)]
+    return None
+
+
+def prune_cache(
+    directory: str,
+    suffix: str,
+    max_entries: int,
+    max_bytes: int,
+    keep: Iterable[str] = (),
+) -> None:
+    # Записи текущей сборки (keep) и самая свежая запись остаются всегда,
+    # даже если они одни больше лимитов
+    kept = {os.path.join(directory, name) for name in keep}
+    entries = []
+    with suppress(FileNotFoundError), os.scandir(directory) as scan:
+        for entry in scan:
+            if not entry.name.endswith(suffix):
+                continue
+            with suppress(FileNotFoundError):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+    total = 0
+    for index, (_, size, path) in enumerate(entries):
+        total += size
+        if path in kept or not index:
+            continue
+        if index >= max_entries or total > max_bytes:
+            # Запись могла удалить параллельная сборка
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def build_key(
+    context: ConversionContext, graph: IncludeGraph, optimize: bool, stream: bool
+) -> str:
+    payload = json.dumps(
+        [
+            file_digest(context, __file__),
+            library_version("markdown", "Markdown"),
+            library_version("docx", "python-docx"),
+            context.root_directory,
+            context.backend,
+            optimize,
+            stream,
+            context.access_date,
+            [(path, file_digest(context, path)) for path in graph.sources],
+        ]
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def build_cache_name(key: str) -> str:
+    # Имя документа зависит только от версий библиотек, а кэш сборок ещё и
+    # сбрасывается переустановкой той же версии
+    payload = json.dumps([key, library_stamp("markdown"), library_stamp("docx")])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def convert_markdown_to_docx(
+    root_directory: str,
+    output_docx: str | None = None,
+    cache_dir: str | None = FRAGMENT_CACHE_DIR,
+    jobs: int = 1,
+    template: bytes | None = None,
+    profile: BuildProfile | None = None,
+    backend: str = BACKEND_BS4,
+    optimize: bool = False,
+    stream: bool = False,
+    depfile: str | None = None,
+    fragment_memory: dict[str, Fragment] | None = None,
+    emit: list[str] | None = None,
+) -> bool:
+    readme_path = os.path.join(root_directory, README_FILE)
+
+    if not os.path.exists(readme_path):
+        print(f"{README_FILE} not found!")
+        return False
+
+    context = ConversionContext(
+        root_directory=root_directory,
+        cache_dir=(
+            None if cache_dir is None else os.path.join(root_directory, cache_dir)
+        ),
+        template=template,
+        profile=profile,
+        backend=backend,
+        access_date=access_date(),
+        fragment_memory=fragment_memory,
+    )
+    graph = scan_includes(readme_path)
+    report_include_graph(graph)
+    image_paths = [path for path in graph.sources if is_image_extension(path)]
+    read_images(context, image_paths)
+    key = build_key(context, graph, optimize, stream)
+    if output_docx is None:
+        output_docx = OUTPUT_FILE.format(key[:BUILD_KEY_LENGTH])
+    if depfile is not None:
+        write_depfile(graph, output_docx, depfile)
+    # При замерах и выводе в другие форматы нужна настоящая сборка
+    cached_docx = None
+    if context.cache_dir is not None and profile is None and not emit:
+        cached_docx = os.path.join(
+            context.cache_dir, BUILD_CACHE_DIR, f"{build_cache_name(key)}.docx"
+        )
+        try:
+            shutil.copyfile(cached_docx, output_docx)
+            os.utime(cached_docx)
+        except FileNotFoundError:
+            pass
+        else:
+            print(f"Document saved as {output_docx} (cached build)")
+            return True
+
+    document = new_document(template)
+    probe_images(context, image_paths)
+    root_key = (readme_path, 1, False, False)
+    with FragmentSpill() if stream else nullcontext() as spill:
+        context.spill = spill
+        # Замеры по этапам возможны только в этом процессе
+        fragments = collect_fragments(context, root_key, 1 if profile else jobs)
+        if optimize:
+            with profile_stage(context, STAGE_IMAGES, output_docx):
+                optimize_images(context, fragments)
+        root = number_fragment(context, fragments, root_key, set())
+        if emit:
+            blocks = document_blocks(context, root)
+            for emit_path in emit:
+                EMITTERS[os.path.splitext(emit_path)[1].lower()](blocks, emit_path)
+                print(f"Document saved as {emit_path}")
+        if stream:
+            context.writer = StreamingDocxWriter(document, output_docx)
+        context.image_prefetch = ImagePrefetch(context, root)
+        try:
+            splice_fragment(context, document, root)
+
+            add_references_section(context, document)
+
+            with profile_stage(context, STAGE_SAVE, output_docx):
+                if context.writer is not None:
+                    context.writer.close()
+                else:
+                    save_document(document, output_docx)
+        except BaseException:
+            if context.writer is not None:
+                context.writer.abort()
+            raise
+        finally:
+            context.image_prefetch.close()
+            context.image_prefetch = None
+    if cached_docx is not None:
+        os.makedirs(os.path.dirname(cached_docx), exist_ok=True)
+        tmp_path = f"{cached_docx}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(output_docx, tmp_path)
+        os.replace(tmp_path, cached_docx)
+        prune_cache(
+            os.path.dirname(cached_docx),
+            ".docx",
+            BUILD_CACHE_ENTRIES,
+            BUILD_CACHE_BYTES,
+        )
+    if profile is not None:
+        profile.root = root
+        profile.output = output_docx
     print(f"Document saved as {output_docx}")
+    return True
+
+
+def convert_many(
+    builds: list[tuple[str, str]],
+    max_workers: int | None = None,
+    use_processes: bool = False,
+    cache_dir: str | None = FRAGMENT_CACHE_DIR,
+    backend: str = BACKEND_BS4,
+    optimize: bool = False,
+    stream: bool = False,
+) -> list[Exception | None]:
+    if use_processes:
+        executor = process_pool(max_workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    with executor:
+        futures = [
+            executor.submit(
+                convert_markdown_to_docx,
+                root_directory,
+                output_docx,
+                cache_dir,
+                backend=backend,
+                optimize=optimize,
+                stream=stream,
+            )
+            for root_directory, output_docx in builds
+        ]
+    return [future.exception() for future in futures]
+
+
+def source_mtimes(readme_path: str) -> dict[str, int | None]:
+    # Отсутствующие файлы, в том числе сам README.md, записываются как None:
+    # их появление тоже считается изменением
+    mtimes: dict[str, int | None] = {}
+    for path in scan_includes(readme_path).sources:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def changed_sources(mtimes: dict[str, int | None]) -> bool:
+    for path, mtime in mtimes.items():
+        try:
+            current = os.stat(path).st_mtime_ns
+        except OSError:
+            current = None
+        if current != mtime:
+            return True
+    return False
+
+
+def watch(
+    root_directory: str,
+    output_docx: str | None = None,
+    interval: float = WATCH_INTERVAL,
+    debounce: float = WATCH_DEBOUNCE,
+    **options,
+) -> None:
+    # Шаблон и отрендеренные фрагменты живут между пересборками, поэтому
+    # заново разбираются только главы с изменёнными исходниками
+    readme_path = os.path.join(root_directory, README_FILE)
+    output_docx = output_docx or WATCH_OUTPUT_FILE
+    tmp_path = f"{output_docx}.{os.getpid()}.tmp"
+    template = create_document_template()
+    fragment_memory: dict[str, Fragment] = {}
+    while True:
+        started = time.perf_counter()
+        try:
+            if convert_markdown_to_docx(
+                root_directory,
+                tmp_path,
+                template=template,
+                fragment_memory=fragment_memory,
+                **options,
+            ):
+                # Открытый в просмотрщике файл подменяется целиком
+                os.replace(tmp_path, output_docx)
+                print(f"Rebuilt {output_docx} in {time.perf_counter() - started:.2f}s")
+        except Exception as e:
+            print(f"Build failed: {type(e).__name__}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        mtimes = source_mtimes(readme_path)
+        print(f"Watching {len(mtimes)} files, Ctrl+C to stop")
+
+        while not changed_sources(mtimes):
+            time.sleep(interval)
+        # Ждём, пока редактор закончит сохранять все файлы
+        current = source_mtimes(readme_path)
+        while True:
+            time.sleep(debounce)
+            settled = source_mtimes(readme_path)
+            if settled == current:
+                break
+            current = settled
+
+
+def parse_import_times(output: str) -> list[tuple[int, int, int, str]]:
+    return [
+        (int(match[1]), int(match[2]), len(match[3]), match[4])
+        for match in IMPORT_TIME_PATTERN.finditer(output)
+    ]
+
+
+def format_import_times(
+    title: str, total: int, entries: list[tuple[int, int, int, str]], limit: int
+) -> list[str]:
+    lines = [
+        f"{title}: {total / 1000:.1f} ms",
+        f"{'cumulative':>12}{'self':>10}  module",
+    ]
+    costliest = sorted(entries, key=lambda entry: entry[1], reverse=True)[:limit]
+    for self_us, cumulative_us, _, name in costliest:
+        lines.append(f"{cumulative_us / 1000:>10.1f}ms{self_us / 1000:>8.1f}ms  {name}")
+    return lines
+
+
+def startup_report(limit: int = STARTUP_REPORT_LIMIT) -> str:
+    # Замер в новом процессе: в текущем модули уже загружены
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    code = (
+        f"import sys, {module_name}; "
+        f"print({STARTUP_REPORT_MARKER!r}, file=sys.stderr, flush=True); "
+        f"{module_name}.import_dependencies()"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    startup_output, _, build_output = completed.stderr.partition(STARTUP_REPORT_MARKER)
+
+    # Вложенные импорты печатаются до строки импортирующего модуля
+    startup = parse_import_times(startup_output)
+    root = max(i for i, entry in enumerate(startup) if entry[3] == module_name)
+    root_self, root_total, root_depth, _ = startup[root]
+    children = []
+    for entry in reversed(startup[:root]):
+        if entry[2] <= root_depth:
+            break
+        if entry[2] == root_depth + 2:
+            children.append(entry)
+
+    build = parse_import_times(build_output)
+    build_depth = min((entry[2] for entry in build), default=0)
+    build_roots = [entry for entry in build if entry[2] == build_depth]
+    lines = format_import_times(f"import {module_name}", root_total, children, limit)
+    lines.append(f"{root_self / 1000:>10.1f}ms{'':>10}  own module body")
+    lines.append("")
+    lines.extend(
+        format_import_times(
+            "import_dependencies() on first build",
+            sum(entry[1] for entry in build_roots),
+            build_roots,
+            limit,
+        )
+    )
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Convert README.md tree to docx")
+    parser.add_argument("root_directory", nargs="?", default=".")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=f"output file, {OUTPUT_FILE.format('<build key>')} by default",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes rendering chapters, 0 - one per CPU",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="ignore the fragment and build caches"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report time and peak memory per stage and file (runs serially)",
+    )
+    parser.add_argument("--pstats", help="write cProfile statistics to this file")
+    parser.add_argument(
+        "--depfile", help="write a make/ninja depfile listing the build inputs"
+    )
+    parser.add_argument(
+        "--emit",
+        action="append",
+        metavar="FILE",
+        help="also write the document as .html, .txt or .json search index",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=f"rebuild when sources change, into {WATCH_OUTPUT_FILE} by default",
+    )
+    parser.add_argument(
+        "--startup-report",
+        action="store_true",
+        help="list the costliest imports at startup and on the first build",
+    )
+    parser.add_argument(
+        "--deps",
+        action="store_true",
+        help="print the files the build depends on and exit without converting",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=MARKDOWN_BACKENDS,
+        default=BACKEND_BS4,
+        help="render from HTML parsed by bs4 or, experimentally, from the Markdown"
+        " element tree",
+    )
+    parser.add_argument(
+        "--optimize-images",
+        action="store_true",
+        help=f"downscale images to {IMAGE_DPI} DPI at the page width and recompress",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write document.xml and images into the archive while assembling",
+    )
+    args = parser.parse_args()
+    for emit_path in args.emit or []:
+        if os.path.splitext(emit_path)[1].lower() not in EMITTERS:
+            parser.error(f"--emit supports {', '.join(EMITTERS)} files: {emit_path}")
+    return args
 
 
 if __name__ == "__main__":
-    root_directory = "."
-    output_docx_file = OUTPUT_FILE
-    convert_markdown_to_docx(root_directory, output_docx_file)
+    args = parse_args()
+    if args.startup_report:
+        print(startup_report())
+        raise SystemExit(0)
+    if args.deps:
+        include_graph = scan_includes(os.path.join(args.root_directory, README_FILE))
+        report_include_graph(include_graph)
+        print("\n".join(include_graph.sources))
+        raise SystemExit(1 if include_graph.cycles else 0)
+    if args.watch:
+        try:
+            watch(
+                args.root_directory,
+                args.output,
+                cache_dir=None if args.no_cache else FRAGMENT_CACHE_DIR,
+                jobs=args.jobs or os.cpu_count() or 1,
+                backend=args.backend,
+                optimize=args.optimize_images,
+                stream=args.stream,
+            )
+        except KeyboardInterrupt:
+            raise SystemExit(0)
+    build_profile = BuildProfile() if args.profile else None
+    profiler = cProfile.Profile() if args.pstats else None
+    if build_profile is not None:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    convert_markdown_to_docx(
+        args.root_directory,
+        args.output,
+        cache_dir=None if args.no_cache else FRAGMENT_CACHE_DIR,
+        jobs=args.jobs or os.cpu_count() or 1,
+        profile=build_profile,
+        backend=args.backend,
+        optimize=args.optimize_images,
+        stream=args.stream,
+        depfile=args.depfile,
+        emit=args.emit,
+    )
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.pstats)
+    if build_profile is not None:
+        tracemalloc.stop()
+        print(format_profile_report(build_profile))
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import time
+
+SOCKET_PATH = os.path.join(tempfile.gettempdir(), f"md_to_docx-{os.getuid()}.sock")
+BUFFER_SIZE = 65536
+
+
+class ConversionHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        # Пустое соединение - проверка из serve(), что сервер уже запущен
+        if not line:
+            return
+        try:
+            job = json.loads(line)
+            response = self.server.run_job(job)
+        except Exception as e:
+            response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response, ensure_ascii=False).encode() + b"\n")
+
+
+class ConversionServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str) -> None:
+        # Тяжёлые импорты и стилизация шаблона выполняются один раз на процесс
+        import md_to_docx
+
+        md_to_docx.import_dependencies()
+        self.converter = md_to_docx
+        self.template = md_to_docx.create_document_template()
+        super().__init__(socket_path, ConversionHandler)
+
+    def run_job(self, job: dict) -> dict:
+        started = time.perf_counter()
+        saved = self.converter.convert_markdown_to_docx(
+            job["root_directory"],
+            job["output"],
+            cache_dir=(
+                self.converter.FRAGMENT_CACHE_DIR if job.get("cache", True) else None
+            ),
+            jobs=job.get("jobs", 1),
+            template=self.template,
+            backend=job.get("backend", self.converter.BACKEND_BS4),
+            optimize=job.get("optimize_images", False),
+            stream=job.get("stream", False),
+        )
+        if not saved:
+            return {"ok": False, "error": f"{self.converter.README_FILE} not found"}
+        return {
+            "ok": True,
+            "output": job["output"],
+            "elapsed": time.perf_counter() - started,
+        }
+
+
+def server_running(socket_path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+
+def serve(socket_path: str = SOCKET_PATH) -> None:
+    # Удаляется только сокет, оставшийся от упавшего сервера, а не живой
+    if server_running(socket_path):
+        print(f"A server is already listening on {socket_path}", file=sys.stderr)
+        sys.exit(1)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with ConversionServer(socket_path) as server:
+        print(f"Listening on {socket_path}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+def submit(
+    root_directory: str,
+    output: str,
+    socket_path: str = SOCKET_PATH,
+    jobs: int = 1,
+    cache: bool = True,
+    backend: str = "bs4",
+    optimize_images: bool = False,
+    stream: bool = False,
+) -> dict:
+    job = {
+        "root_directory": os.path.abspath(root_directory),
+        "output": os.path.abspath(output),
+        "jobs": jobs,
+        "cache": cache,
+        "backend": backend,
+        "optimize_images": optimize_images,
+        "stream": stream,
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(job, ensure_ascii=False).encode() + b"\n")
+        response = b""
+        while not response.endswith(b"\n"):
+            chunk = client.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            response += chunk
+    return json.loads(response)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Warm md_to_docx server and client")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("serve", help="start the conversion server")
+
+    convert = subparsers.add_parser("convert", help="send a job to the server")
+    convert.add_argument("root_directory", nargs="?", default=".")
+    convert.add_argument("-o", "--output", required=True)
+    convert.add_argument("-j", "--jobs", type=int, default=1)
+    convert.add_argument("--no-cache", action="store_true")
+    convert.add_argument("--backend", choices=("etree", "bs4"), default="bs4")
+    convert.add_argument("--optimize-images", action="store_true")
+    convert.add_argument("--stream", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "serve":
+        serve(args.socket)
+    else:
+        result = submit(
+            args.root_directory,
+            args.output,
+            socket_path=args.socket,
+            jobs=args.jobs,
+            cache=not args.no_cache,
+            backend=args.backend,
+            optimize_images=args.optimize_images,
+            stream=args.stream,
+        )
+        if not result["ok"]:
+            print(result["error"], file=sys.stderr)
+            sys.exit(1)
+        print(f"Document saved as {result['output']} in {result['elapsed']:.3f}s")